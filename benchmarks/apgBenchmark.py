@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Compares apgAlgo, run sample by sample, with apgAlgoBatch on the same initial points.
+# The line searches of APG amplify the float32 rounding differences between the batched and the
+# per sample kernels, so the mus of a sample may differ noticeably while the mean utilities agree.
+# Usage: python benchmarks/apgBenchmark.py [-b BATCH_SIZE] [-sc SCENARIOS ...] [-v 1] [-d cuda]
+#            [-tol TOLERANCE]
+# -v 1 draws between K/2 and K users per sample and pads the batch, as in the varying K runs.
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gradBenchmark import getBatch
+from powerControl.channelContext import ChannelContext
+from powerControl.testing import apgAlgo, apgAlgoBatch, apgInit
+from powerControl.utils import PILOT_PAD
+
+# betas of the padded users, as in RootNet
+PAD_CONST = 6e-13
+
+
+def main():
+    parser = argparse.ArgumentParser(description='APG benchmark')
+    parser.add_argument('-b', '--batchSize', type=int, default=64)
+    parser.add_argument('-d', '--device', default='cpu')
+    parser.add_argument('-sc', '--scenarios', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('-v', '--varyingNumberOfUsers', choices={'0', '1'}, default='0')
+    parser.add_argument('-tol', '--tolerance', type=float, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print(f'{"Sc.":>4}{"M":>6}{"K":>5}{"B":>6}{"per sample [s]":>16}{"batched [s]":>13}'
+          f'{"speed-up":>10}{"utility (per sample)":>22}{"utility (batched)":>19}'
+          f'{"iterations":>12}')
+    for scenario in args.scenarios:
+        systemParameters, betas, _, _, pilotSequences = getBatch(scenario, args.batchSize, device)
+        [B, M, K] = betas.shape
+        numberOfUsers = torch.full((B,), K, device=device)
+        if args.varyingNumberOfUsers == '1':
+            numberOfUsers = torch.randint(K // 2, K + 1, (B,), device=device)
+            userMask = torch.arange(K, device=device) < numberOfUsers.view(-1, 1)
+            pilotSequences = torch.where(userMask, pilotSequences, PILOT_PAD)
+            betas = torch.where(userMask.unsqueeze(1), betas, PAD_CONST)
+        init = apgInit(betas, device)
+
+        with torch.no_grad():
+            timeThen = time.perf_counter()
+            utilityList = []
+            iterationsList = []
+            for b in range(B):
+                k = numberOfUsers[b]
+                channelContext = ChannelContext(
+                                                    betas[b:b + 1, :, :k],
+                                                    pilotSequences[b:b + 1, :k],
+                                                    systemParameters
+                                                )
+                sampleInit = (init[0][b:b + 1, :, :k], init[1][b:b + 1, :, :k])
+                _, utility, iterations = apgAlgo(
+                                                    channelContext,
+                                                    device,
+                                                    init=sampleInit,
+                                                    tolerance=args.tolerance
+                                                )
+                utilityList.append(utility)
+                iterationsList.append(iterations)
+            perSampleTime = time.perf_counter() - timeThen
+
+            timeThen = time.perf_counter()
+            channelContext = ChannelContext(
+                                                betas,
+                                                pilotSequences,
+                                                systemParameters,
+                                                maskPaddedUsers=True
+                                            )
+            _, utilityBatch, iterationsBatch = apgAlgoBatch(
+                                                            channelContext,
+                                                            device,
+                                                            init=init,
+                                                            tolerance=args.tolerance
+                                                        )
+            batchedTime = time.perf_counter() - timeThen
+
+        perSampleUtility = torch.stack(utilityList).mean().item()
+        batchedUtility = utilityBatch.mean().item()
+        iterations = sum(iterationsList) / B
+        print(f'{scenario:>4}{M:>6}{K:>5}{B:>6}{perSampleTime:>16.2f}{batchedTime:>13.2f}'
+              f'{perSampleTime / batchedTime:>10.1f}{perSampleUtility:>22.4f}'
+              f'{batchedUtility:>19.4f}{iterations:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
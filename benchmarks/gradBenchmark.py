@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Compares the per-user loop (grad_fLoop), the vectorized grad_f and the co-pilot group kernel
+# grad_fPilots of Eq (42) on every scenario.
+# Usage: python benchmarks/gradBenchmark.py [-b BATCH_SIZE] [-t TRIALS] [-ch CHUNK_SIZE] [-d cuda]
+#            [-sc SCENARIOS ...] [-k NUMBER_OF_USERS]
+# -k overrides the number of users of the scenarios, e.g. to try out larger K.
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parameters.modes import OperatingModes
+from parameters.sysParams import SystemParameters
+from generateBetaAndPilots import SampleGenerator
+from powerControl.utils import compute_v_mat, compute_v_matPilots, getPilotGroups
+from powerControl.gradientHandler import grad_f, grad_fLoop, grad_fPilots
+
+
+def getBatch(scenario, batchSize, device, numberOfUsers=None):
+    simulationParameters = SimpleNamespace(
+                                                scenario=scenario,
+                                                device=device,
+                                                rootPath=os.getcwd(),
+                                                operationMode=OperatingModes.TRAINING,
+                                                varyingNumberOfUsersFlag=False,
+                                                minNumberOfUsersFlag=False,
+                                                randomPilotsFlag=False,
+                                                handleModelSubFolders=lambda models: None,
+                                            )
+    systemParameters = SystemParameters(simulationParameters)
+    if numberOfUsers is not None:
+        systemParameters.maxNumberOfUsers = numberOfUsers
+        systemParameters.minNumberOfUsers = numberOfUsers
+    sampleGenerator = SampleGenerator(simulationParameters, systemParameters, 'benchmark')
+    betas, pilotSequences, _ = sampleGenerator.generate(0, batchSize)
+
+    phi = systemParameters.phiOrth[pilotSequences]  # B X K X Tp
+    phiCrossMat = torch.abs(phi @ phi.transpose(1, 2))
+    mus = torch.rand(betas.shape) / systemParameters.numberOfAccessPoints**0.5
+    return (
+                systemParameters,
+                betas.to(device),
+                mus.to(device),
+                phiCrossMat.to(device),
+                pilotSequences.to(device)
+            )
+
+
+def timeIt(function, trials, device):
+    function()  # warm-up
+    latencies = []
+    for _ in range(trials):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='grad_f benchmark')
+    parser.add_argument('-b', '--batchSize', type=int, default=1024)
+    parser.add_argument('-t', '--trials', type=int, default=5)
+    parser.add_argument('-ch', '--chunkSize', type=int, default=None)
+    parser.add_argument('-d', '--device', default='cpu')
+    parser.add_argument('-sc', '--scenarios', type=int, nargs='+', default=[0, 1, 2, 3])
+    parser.add_argument('-k', '--numberOfUsers', type=int, default=None)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print(f'{"Sc.":>4}{"M":>6}{"K":>5}{"B":>6}{"loop [ms]":>12}{"vectorized [ms]":>17}'
+          f'{"pilots [ms]":>13}{"speed-up":>10}{"max rel. diff":>15}')
+    for scenario in args.scenarios:
+        systemParameters, betas, mus, phiCrossMat, pilotSequences = getBatch(
+                                                                            scenario,
+                                                                            args.batchSize,
+                                                                            device,
+                                                                            args.numberOfUsers
+                                                                        )
+        commonArgs = (
+                        betas,
+                        mus,
+                        systemParameters.numberOfAntennas,
+                        systemParameters.zeta_d,
+                        systemParameters.Tp,
+                        systemParameters.Tc,
+                    )
+        vMat = compute_v_mat(betas, systemParameters.zeta_p, systemParameters.Tp, phiCrossMat)
+        gradArgs = (*commonArgs, phiCrossMat, vMat, systemParameters.tau, device)
+
+        vMatPilots = compute_v_matPilots(
+                                            betas,
+                                            systemParameters.zeta_p,
+                                            systemParameters.Tp,
+                                            pilotSequences
+                                        )
+        pilotGroups = getPilotGroups(pilotSequences, systemParameters.Tp)
+        gradPilotsArgs = (*commonArgs, pilotGroups, vMatPilots, systemParameters.tau, device)
+
+        with torch.no_grad():
+            loopTime = timeIt(lambda: grad_fLoop(*gradArgs), args.trials, device)
+            vectorizedTime = timeIt(
+                                        lambda: grad_f(*gradArgs, chunkSize=args.chunkSize),
+                                        args.trials,
+                                        device
+                                    )
+            pilotsTime = timeIt(lambda: grad_fPilots(*gradPilotsArgs), args.trials, device)
+            gradLoop, _ = grad_fLoop(*gradArgs)
+            gradVectorized, _ = grad_f(*gradArgs, chunkSize=args.chunkSize)
+            gradPilots, _ = grad_fPilots(*gradPilotsArgs)
+        relDiff = max(
+                        ((gradLoop - grad).abs().max() / gradLoop.abs().max()).item()
+                        for grad in [gradVectorized, gradPilots]
+                    )
+
+        M, K = systemParameters.numberOfAccessPoints, systemParameters.maxNumberOfUsers
+        print(f'{scenario:>4}{M:>6}{K:>5}{args.batchSize:>6}{1e3 * loopTime:>12.2f}'
+              f'{1e3 * vectorizedTime:>17.2f}{1e3 * pilotsTime:>13.2f}'
+              f'{loopTime / min(vectorizedTime, pilotsTime):>10.1f}{relDiff:>15.1e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,7 @@ Try 'python cellFreeMassMimoPowCtrl.py -h' to learn about passing optional comma
 from parameters.simParams import SimulationParameters
 from parameters.sysParams import SystemParameters
 
-from generateBetaAndPilots import dataGen
+from generateBetaAndPilots import generateData
 
 from powerControl.learning import train
 from powerControl.testing import testAndPlot
@@ -32,9 +32,7 @@ def dataGenAndTest(args):
     simulationParameters = SimulationParameters(args)
     systemParameters = SystemParameters(simulationParameters)
 
-    if not os.listdir(simulationParameters.dataFolder):
-        for sampleId in range(args.numberOfSamples):
-            dataGen(simulationParameters, systemParameters, sampleId)
+    generateData(simulationParameters, systemParameters, args.numberOfSamples)
 
     testAndPlot(simulationParameters, systemParameters, plottingOnly=False)
 
@@ -51,26 +49,27 @@ if __name__ == '__main__':
         systemParameters = SystemParameters(simulationParameters)
 
         # Generating train & validation or test data.
-        if not (simulationParameters.operationMode == OperatingModes.PLOTTING_ONLY):
-            if not os.listdir(simulationParameters.dataFolder):
-                timeThen = time.perf_counter()
-                
-                for sampleId in range(args.numberOfSamples):
-                    # Generates Train/Test data
-                    dataGen(simulationParameters, systemParameters, sampleId)
-                    
-                    if ((simulationParameters.operationMode == OperatingModes.TRAINING)
-                        and (sampleId < simulationParameters.validationNumberOfData)):
-                            # Generates Validation data
-                            dataGen(
+        if not ((simulationParameters.operationMode == OperatingModes.PLOTTING_ONLY)
+                or (simulationParameters.operationMode == OperatingModes.SERVE)
+                or (simulationParameters.operationMode == OperatingModes.EXPORT)
+                or simulationParameters.streamingDataFlag):
+            # Generates only the samples missing from the data folders.
+            timeThen = time.perf_counter()
+            
+            # Generates Train/Test data
+            generateData(simulationParameters, systemParameters, args.numberOfSamples)
+            
+            if simulationParameters.operationMode == OperatingModes.TRAINING:
+                # Generates Validation data
+                generateData(
                                 simulationParameters,
                                 systemParameters,
-                                sampleId,
+                                simulationParameters.validationNumberOfData,
                                 validationData=True
-                                )
-                
-                timeNow = time.perf_counter()
-                print(f'Finished data generation in {round(timeNow - timeThen, 2)} second(s)')
+                            )
+            
+            timeNow = time.perf_counter()
+            print(f'Finished data generation in {round(timeNow - timeThen, 2)} second(s)')
 
         # Training and/or test the power control algorithms.
         if simulationParameters.operationMode==OperatingModes.TRAINING:
@@ -87,9 +86,7 @@ if __name__ == '__main__':
                 simulationParameters = SimulationParameters(args)
                 systemParameters = SystemParameters(simulationParameters)
 
-                if not os.listdir(simulationParameters.dataFolder):
-                    for sampleId in range(args.numberOfSamples):
-                        dataGen(simulationParameters, systemParameters, sampleId)
+                generateData(simulationParameters, systemParameters, args.numberOfSamples)
 
                 testAndPlot(simulationParameters, systemParameters, plottingOnly=False)
 
@@ -99,6 +96,18 @@ if __name__ == '__main__':
 
         elif simulationParameters.operationMode==OperatingModes.PLOTTING_ONLY:
             testAndPlot(simulationParameters, systemParameters, plottingOnly=True)
+
+        elif simulationParameters.operationMode==OperatingModes.BENCHMARK:
+            from powerControl.benchmarking import benchmark
+            benchmark(simulationParameters, systemParameters)
+
+        elif simulationParameters.operationMode==OperatingModes.SERVE:
+            from powerControl.serving import serve
+            serve(simulationParameters, systemParameters)
+
+        elif simulationParameters.operationMode==OperatingModes.EXPORT:
+            from powerControl.exporting import exportModels
+            exportModels(simulationParameters, systemParameters)
     elif args.operatingMode == OperatingModes.CONSOL:
         from utils.utils import handleDeletionAndCreation
         from powerControl.testing import consolidatePlot
@@ -6,4 +6,7 @@ rmdir /Q /S simId3
 rmdir /Q /S simId4
 rmdir /Q /S simId5
 rmdir /Q /S consolidatedResults
-rmdir /Q /S updatedResults
\ No newline at end of file
+rmdir /Q /S updatedResults
+rmdir /Q /S geometryCache
+rmdir /Q /S baselineCache
+rmdir /Q /S locks
\ No newline at end of file
@@ -1,28 +1,50 @@
 # -*- coding: utf-8 -*-
 import torch
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from parameters.geometry import GEOMETRY_CACHE_VERSION
+from utils.sampleStore import getShardSize, writeShard, writeManifest, loadManifest
 
-def getUserConfig(areaWidth, areaHeight, numberOfUsers, device):
+
+# Upper bound on the number of elements of the largest intermediate tensor (the distance
+# computation) built by one generateBatch call.
+DATA_GEN_MAX_ELEMENTS = 2**24
+
+# Bump this whenever the samples generated for a given seed change, so that data folders of the
+# previous version are regenerated instead of extended.
+DATA_GEN_VERSION = 1
+
+
+def sampleSeed(scenario, split, sampleId):
+    # All the randomness of a sample comes from this seed, so a sample does not depend on which
+    # process generates it or on which other samples are generated along with it.
+    key = f'{scenario}/{split}/{sampleId}'.encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+def getUserConfig(areaWidth, areaHeight, numberOfUsers, generator):
     areaDims = torch.tensor(
             [areaWidth, areaHeight],
-            device=device,
             requires_grad=False,
             dtype=torch.float32
         )
-    torch.seed()
     randVec = torch.rand(
                             (2, numberOfUsers),
-                            device=device,
+                            generator=generator,
                             requires_grad=False,
                             dtype=torch.float32
                         ) - 0.5
-    userConfig = torch.einsum('d,dm->md ', areaDims, randVec).to(device)
+    userConfig = torch.einsum('d,dm->md ', areaDims, randVec)
     return userConfig
 
-def get_dMat(userConfig, apMinusRef):
-    d2 = userConfig.view(-1, 1, 1, 2) - apMinusRef
-    dMat, _ = torch.min((torch.sqrt(torch.einsum('kmtc->mkt', d2**2))), dim=-1)
+def get_dMat(userConfig, apPositions, areaDims):
+    # Wrap-around distance between every AP and user.
+    # userConfig is of dimension ... X K X 2 and the output is of dimension ... X M X K
+    # Along each axis, the nearest periodic image of an AP is at most half the area away.
+    d = torch.abs(userConfig.unsqueeze(-3) - apPositions.unsqueeze(-2))  # ... X M X K X 2
+    d = torch.minimum(d, areaDims - d)
+    dMat = torch.sqrt((d**2).sum(dim=-1))
     return dMat
 
 def pathLossModel(L, d0, d1, log_d0, log_d1, dMat):
@@ -33,65 +55,285 @@ def pathLossModel(L, d0, d1, log_d0, log_d1, dMat):
     PL = PL0 + PL1 + PL2
     return PL
 
-def getLSFs(L, d0, d1, log_d0, log_d1, sigma_sh, dMat, device):
-    torch.seed()
-    ZTemp = torch.normal(
+def getShadowing(sigma_sh, numberOfAccessPoints, numberOfUsers, generator):
+    return torch.normal(
                             mean=0,
                             std=sigma_sh,
-                            size=dMat.shape,
-                            device=device,
+                            size=(numberOfAccessPoints, numberOfUsers),
+                            generator=generator,
                             requires_grad=False,
                             dtype=torch.float32
                         )
+
+def getLSFs(L, d0, d1, log_d0, log_d1, dMat, ZTemp):
     PL = pathLossModel(L, d0, d1, log_d0, log_d1, dMat) + ZTemp
     betas = 10 ** (PL / 10)
     return betas
 
-def dataGen(simulationParameters, systemParameters, sampleId, validationData=False):
+def getPilotSequence(numberOfUsers, Tp, randomPilotsFlag, generator):
+    # The first min(K, Tp) users get unique pilots and the rest re-use random pilots, so the
+    # first K' entries are a valid allocation for any K' <= K (used for varying K).
+    if randomPilotsFlag:
+        return torch.randint(0, Tp, (numberOfUsers,), generator=generator)
+
+    uniquePilotAllocation = torch.randperm(Tp, generator=generator)
+    additionalNumOfUsers = numberOfUsers - Tp
+    if additionalNumOfUsers<=0:
+        return uniquePilotAllocation[:numberOfUsers]
+
+    reUsedPilotAllocation = torch.randint(0, Tp, (additionalNumOfUsers,), generator=generator)
+    return torch.cat((uniquePilotAllocation, reUsedPilotAllocation), dim=0)
+
+
+class SampleGenerator:
+    # Holds CPU copies of everything needed to generate the samples of one data split, so it can
+    # be sent to worker processes.
+
+    def __init__(self, simulationParameters, systemParameters, split):
+        cpu = torch.device('cpu')
+        self.scenario = simulationParameters.scenario
+        self.split = split
+        self.varyingNumberOfUsersFlag = simulationParameters.varyingNumberOfUsersFlag
+        self.minNumberOfUsersFlag = simulationParameters.minNumberOfUsersFlag
+        self.randomPilotsFlag = simulationParameters.randomPilotsFlag
+
+        self.areaWidth = systemParameters.areaWidth.item()
+        self.areaHeight = systemParameters.areaHeight.item()
+        self.apPositions = systemParameters.apPositions.to(cpu)
+        self.areaDims = systemParameters.areaDims.to(cpu)
+        self.param_L = systemParameters.param_L.to(cpu)
+        self.d0 = systemParameters.d0.to(cpu)
+        self.d1 = systemParameters.d1.to(cpu)
+        self.log_d0 = systemParameters.log_d0.to(cpu)
+        self.log_d1 = systemParameters.log_d1.to(cpu)
+        self.sigma_sh = systemParameters.sigma_sh
+        self.Tp = systemParameters.Tp
+        self.numberOfAccessPoints = systemParameters.numberOfAccessPoints
+        self.maxNumberOfUsers = systemParameters.maxNumberOfUsers
+        self.minNumberOfUsers = systemParameters.minNumberOfUsers
+
+        M = self.numberOfAccessPoints
+        K = self.maxNumberOfUsers
+        self.batchSize = max(1, DATA_GEN_MAX_ELEMENTS // (M * K * 2))
+
+    def getConfig(self):
+        # Everything the generated samples depend on
+        return {
+                    'version': DATA_GEN_VERSION,
+                    'geometryVersion': GEOMETRY_CACHE_VERSION,
+                    'scenario': self.scenario,
+                    'split': self.split,
+                    'varyingNumberOfUsersFlag': self.varyingNumberOfUsersFlag,
+                    'minNumberOfUsersFlag': self.minNumberOfUsersFlag,
+                    'randomPilotsFlag': self.randomPilotsFlag,
+                    'numberOfAccessPoints': self.numberOfAccessPoints,
+                    'maxNumberOfUsers': self.maxNumberOfUsers,
+                    'minNumberOfUsers': self.minNumberOfUsers,
+                    'Tp': self.Tp,
+                }
+
+    def getNumberOfUsers(self, generator):
+        if self.minNumberOfUsersFlag:
+            return self.minNumberOfUsers
+        if not self.varyingNumberOfUsersFlag:
+            return self.maxNumberOfUsers
+        return torch.randint(
+                                self.minNumberOfUsers,
+                                self.maxNumberOfUsers + 1,
+                                (1, ),
+                                generator=generator
+                            ).item()
+
+    def generateBatch(self, sampleIds):
+        # Returns betas B X M X K_max, pilot sequences B X K_max and the number of users B.
+        # Sample b only keeps its first numberOfUsers[b] users.
+        M = self.numberOfAccessPoints
+        K = self.maxNumberOfUsers
+        numberOfUsers = []
+        userConfigs = []
+        shadowing = []
+        pilotSequences = []
+        for sampleId in sampleIds:
+            seed = sampleSeed(self.scenario, self.split, sampleId)
+            generator = torch.Generator().manual_seed(seed)
+            numberOfUsers.append(self.getNumberOfUsers(generator))
+            userConfigs.append(getUserConfig(self.areaWidth, self.areaHeight, K, generator))
+            shadowing.append(getShadowing(self.sigma_sh, M, K, generator))
+            pilotSequences.append(getPilotSequence(K, self.Tp, self.randomPilotsFlag, generator))
+
+        # distance mat for each pair of AP and user
+        dMat = get_dMat(torch.stack(userConfigs), self.apPositions, self.areaDims)  # B X M X K
+        betas = getLSFs(
+                            self.param_L,
+                            self.d0,
+                            self.d1,
+                            self.log_d0,
+                            self.log_d1,
+                            dMat,
+                            torch.stack(shadowing)
+                        )
+        return betas, torch.stack(pilotSequences), torch.tensor(numberOfUsers)
+
+    def generate(self, startId, count):
+        # Splits the samples into batches aligned to multiples of self.batchSize and uses a single
+        # thread, so the floating point results never depend on how the work is distributed.
+        numberOfThreads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            batches = []
+            stopId = startId + count
+            batchStart = startId
+            while batchStart < stopId:
+                batchStop = min((batchStart // self.batchSize + 1) * self.batchSize, stopId)
+                batches.append(self.generateBatch(range(batchStart, batchStop)))
+                batchStart = batchStop
+        finally:
+            torch.set_num_threads(numberOfThreads)
+        return [torch.cat(items) for items in zip(*batches)]
+
+
+def getSplit(simulationParameters, validationData):
+    from parameters.modes import OperatingModes
     if validationData:
-        filePath = simulationParameters.validationDataFolder
+        return 'validation'
+    if simulationParameters.operationMode == OperatingModes.TRAINING:
+        return 'training'
+    return 'testing'
+
+def getDataFolder(simulationParameters, validationData):
+    if validationData:
+        return simulationParameters.validationDataFolder
+    return simulationParameters.dataFolder
+
+def saveSampleFiles(filePath, startId, betas, pilotSequences, numberOfUsers):
+    # Save the RX data and original channel matrix, one file per sample.
+    for b in range(betas.shape[0]):
+        numberOfUsers_b = numberOfUsers[b].item()
+        m = {
+                'betas': betas[b, :, :numberOfUsers_b].clone(),
+                'pilotSequence': pilotSequences[b, :numberOfUsers_b].clone()
+            }
+        torch.save(m, os.path.join(filePath, f'betasSample{startId + b}.pt'))
+
+def dataGenFiles(sampleGenerator, filePath, shardId, shardSize, numberOfSamples):
+    # Generates and saves the samples of the shard-sized range shardId, one file per sample.
+    startId = shardId * shardSize
+    count = min(shardSize, numberOfSamples - startId)
+    saveSampleFiles(filePath, startId, *sampleGenerator.generate(startId, count))
+    return {'id': shardId, 'count': count}
+
+def dataGenShard(sampleGenerator, filePath, shardId, shardSize, numberOfSamples, betaEncoding):
+    # Generates and saves the samples of shard shardId (see utils.sampleStore).
+    startId = shardId * shardSize
+    count = min(shardSize, numberOfSamples - startId)
+    return writeShard(filePath, shardId, *sampleGenerator.generate(startId, count), betaEncoding)
+
+def dataGen(simulationParameters, systemParameters, sampleId, validationData=False):
+    sampleGenerator = SampleGenerator(
+                                        simulationParameters,
+                                        systemParameters,
+                                        getSplit(simulationParameters, validationData)
+                                    )
+    filePath = getDataFolder(simulationParameters, validationData)
+    saveSampleFiles(filePath, sampleId, *sampleGenerator.generate(sampleId, 1))
+
+def runTask(task):
+    function, *taskArgs = task
+    return function(*taskArgs)
+
+def loadCompleteShards(filePath, config):
+    # Returns the complete shards of the data folder if it was generated with config, and empties
+    # the folder otherwise.
+    from utils.utils import deleteFolderContents
+    manifest = loadManifest(filePath)
+    if manifest is not None and manifest.get('config') == config:
+        return {shard['id']: shard for shard in manifest['shards']}
+
+    if os.listdir(filePath):
+        print(f'The data in {filePath} does not match the requested configuration. Regenerating.')
+        deleteFolderContents(filePath)
+    return {}
+
+def generateData(simulationParameters, systemParameters, numberOfSamples, validationData=False):
+    # Makes the samples 0, ..., numberOfSamples - 1 available in the data folder. Only the shards
+    # missing from the manifest are generated, so an interrupted run resumes where it stopped and
+    # a larger numberOfSamples extends the existing data without touching it. The work is spread
+    # over simulationParameters.numberOfWorkers processes and the data does not depend on the
+    # number of workers.
+    sampleGenerator = SampleGenerator(
+                                        simulationParameters,
+                                        systemParameters,
+                                        getSplit(simulationParameters, validationData)
+                                    )
+    filePath = getDataFolder(simulationParameters, validationData)
+
+    config = sampleGenerator.getConfig()
+    if simulationParameters.shardedDataFlag:
+        config['format'] = 'shards'
+        config['shardSize'] = getShardSize(
+                                            systemParameters.numberOfAccessPoints,
+                                            systemParameters.maxNumberOfUsers
+                                        )
+        config['betaEncoding'] = simulationParameters.betaEncoding
     else:
-        filePath = simulationParameters.dataFolder
-    device = simulationParameters.device
-    areaWidth = systemParameters.areaWidth
-    areaHeight = systemParameters.areaHeight
-    if not simulationParameters.varyingNumberOfUsersFlag:
-        numberOfUsers = systemParameters.maxNumberOfUsers
+        config['format'] = 'files'
+        config['shardSize'] = sampleGenerator.batchSize
+        config['betaEncoding'] = 'float32'
+    shardSize = config['shardSize']
+
+    shards = loadCompleteShards(filePath, config)
+    missingShardIds = []
+    for shardId in range((numberOfSamples + shardSize - 1) // shardSize):
+        count = min(shardSize, numberOfSamples - shardId * shardSize)
+        if shardId in shards and shards[shardId]['count'] >= count:
+            continue
+        # A shorter last shard of a smaller dataset is regenerated as a whole.
+        shards.pop(shardId, None)
+        missingShardIds.append(shardId)
+
+    if not missingShardIds:
+        return
+    print(f'Generating {len(missingShardIds)} of '
+          f'{(numberOfSamples + shardSize - 1) // shardSize} shard(s) in {filePath}')
+    # Drops the shards to be rewritten from the manifest before touching their files.
+    writeManifest(filePath, config, shards.values())
+
+    if simulationParameters.shardedDataFlag:
+        tasks = [
+                    (
+                        dataGenShard,
+                        sampleGenerator,
+                        filePath,
+                        shardId,
+                        shardSize,
+                        numberOfSamples,
+                        simulationParameters.betaEncoding
+                    )
+                    for shardId in missingShardIds
+                ]
     else:
-        numberOfUsers = torch.randint(
-                                            systemParameters.minNumberOfUsers,
-                                            systemParameters.maxNumberOfUsers + 1,
-                                            (1, )
-                                    ).item()
-    if simulationParameters.minNumberOfUsersFlag:
-        numberOfUsers = systemParameters.minNumberOfUsers
-
-    userConfig = getUserConfig(areaWidth, areaHeight, numberOfUsers, device)  # get user positions
-    # distance mat for each pair of AP and user
-    dMat = get_dMat(userConfig, systemParameters.apMinusRef)
-    
-    L = systemParameters.param_L
-    d0 = systemParameters.d0
-    d1 = systemParameters.d1
-    log_d0 = systemParameters.log_d0
-    log_d1 = systemParameters.log_d1
-    sigma_sh = systemParameters.sigma_sh
-    betas = getLSFs(L, d0, d1, log_d0, log_d1, sigma_sh, dMat, device)
-    
-    torch.seed()
-    if simulationParameters.randomPilotsFlag:
-        pilotSequence = torch.randint(0, systemParameters.Tp, (numberOfUsers,))
+        tasks = [
+                    (
+                        dataGenFiles,
+                        sampleGenerator,
+                        filePath,
+                        shardId,
+                        shardSize,
+                        numberOfSamples
+                    )
+                    for shardId in missingShardIds
+                ]
+
+    def completeShard(shard):
+        shards[shard['id']] = shard
+        writeManifest(filePath, config, shards.values())
+
+    numberOfWorkers = min(simulationParameters.numberOfWorkers, len(tasks))
+    if numberOfWorkers <= 1:
+        for task in tasks:
+            completeShard(runTask(task))
     else:
-        additionalNumOfUsers = numberOfUsers - systemParameters.Tp
-        uniquePilotAllocation = torch.randperm(systemParameters.Tp)
-        if additionalNumOfUsers<=0:
-            pilotSequence = uniquePilotAllocation[:numberOfUsers]
-        else:
-            reUsedPilotAllocation = torch.randint(0, systemParameters.Tp, (additionalNumOfUsers,))
-            pilotSequence = torch.cat((uniquePilotAllocation, reUsedPilotAllocation), dim=0)
-    
-
-    # Save the RX data and original channel matrix.
-    m = {'betas': betas.to('cpu'), 'pilotSequence': pilotSequence}
-    torch.save(m, os.path.join(filePath, f'betasSample{sampleId}.pt'))
-    
\ No newline at end of file
+        with ProcessPoolExecutor(max_workers=numberOfWorkers) as executor:
+            futures = [executor.submit(runTask, task) for task in tasks]
+            for future in as_completed(futures):
+                completeShard(future.result())
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import torch
+
+
+# Bump this whenever buildGeometry changes, so that stale cache files are not picked up.
+GEOMETRY_CACHE_VERSION = 1
+GEOMETRY_CACHE_FOLDER = 'geometryCache'
+
+
+def buildGeometry(key):
+    # The AP layout and the pilot basis are drawn from fixed seeds on the CPU, so they are the
+    # same on every machine and device.
+    generator = torch.Generator()
+
+    generator.manual_seed(0)
+    randomMat = torch.normal(0, 1, (key['Tp'], key['Tp']), generator=generator)
+    phiOrth, _, _ = torch.linalg.svd(randomMat)
+
+    areaDims = torch.tensor(
+                                [key['areaWidth'], key['areaHeight']],
+                                requires_grad=False,
+                                dtype=torch.float32
+                            )
+
+    generator.manual_seed(2)
+    randVec = torch.rand(
+                            (2, key['numberOfAccessPoints']),
+                            generator=generator,
+                            requires_grad=False,
+                            dtype=torch.float32
+                        ) - 0.5  # 2 X M
+    apPositions = torch.einsum('d,dm->md ', areaDims, randVec)  # M X 2
+
+    totalNoisePower = 10 ** ((key['No_Hz'] - 30) / 10) * key['bandWidth']\
+        * 10 ** (key['noiseFigure'] / 10)
+
+    return {
+                'key': key,
+                'phiOrth': phiOrth,
+                'areaDims': areaDims,
+                'apPositions': apPositions,
+                'totalNoisePower': totalNoisePower,
+                'zeta_d': key['zeta_d'] / totalNoisePower,
+                'zeta_p': key['zeta_p'] / totalNoisePower,
+            }
+
+
+def loadGeometry(cacheRoot, **keyParams):
+    # Returns the geometry of keyParams from the cache under cacheRoot, building and caching it
+    # on the first use. The cache file is written atomically, so concurrent runs may share it.
+    key = dict(keyParams, version=GEOMETRY_CACHE_VERSION)
+    keyHash = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    cacheFolder = os.path.join(cacheRoot, GEOMETRY_CACHE_FOLDER)
+    filePath = os.path.join(cacheFolder, f'geometry{keyHash}.pt')
+
+    if os.path.isfile(filePath):
+        geometry = torch.load(filePath, weights_only=True)
+        if geometry['key'] == key:
+            return geometry
+
+    geometry = buildGeometry(key)
+    os.makedirs(cacheFolder, exist_ok=True)
+    tempFilePath = f'{filePath}.{os.getpid()}.tmp'
+    torch.save(geometry, tempFilePath)
+    os.replace(tempFilePath, filePath)
+    return geometry
@@ -19,4 +19,13 @@ class OperatingModes(IntEnum):
     CONSOL = auto()
     
     # Fetches Consolidated plots To do further processing
-    LOCAL = auto()
\ No newline at end of file
+    LOCAL = auto()
+    
+    # Measures the latency of all the algos on the test data
+    BENCHMARK = auto()
+    
+    # Serves the power coefficients of the trained models over HTTP
+    SERVE = auto()
+    
+    # Exports the trained models as TorchScript (and ONNX) files
+    EXPORT = auto()
@@ -4,6 +4,7 @@ import sys
 
 from utils.utils import handleDeletionAndCreation
 from parameters.modes import OperatingModes
+from utils.sampleStore import BETA_ENCODINGS
 
 
 
@@ -23,6 +24,18 @@ class SimulationParameters:
             randomPilotsFlag,
             varyingNumberOfUsersFlag,
             minNumberOfUsersFlag,
+            shardedDataFlag,
+            betaEncoding,
+            numberOfWorkers,
+            streamingDataFlag,
+            apgToleranceFlag,
+            refineIterations,
+            quantizeFlag,
+            testBatchSize,
+            numberOfThreads,
+            port,
+            socketPort,
+            maxWait,
         ) = (
                 args.root,
                 args.simulationId,
@@ -34,6 +47,18 @@ class SimulationParameters:
                 args.randomPilotsFlag,
                 args.varyingNumberOfUsersFlag,
                 args.minNumberOfUsersFlag,
+                args.shardedDataFlag,
+                args.betaEncoding,
+                args.numberOfWorkers,
+                args.streamingDataFlag,
+                args.apgToleranceFlag,
+                args.refineIterations,
+                args.quantizeFlag,
+                args.testBatchSize,
+                args.numberOfThreads,
+                args.port,
+                args.socketPort,
+                args.maxWait,
             )
         
         self.numberOfSamples = numberOfSamples
@@ -44,9 +69,30 @@ class SimulationParameters:
         self.randomPilotsFlag = randomPilotsFlag
         self.varyingNumberOfUsersFlag = varyingNumberOfUsersFlag
         self.minNumberOfUsersFlag = minNumberOfUsersFlag
+        self.shardedDataFlag = shardedDataFlag
+        self.betaEncoding = BETA_ENCODINGS[betaEncoding]
+        self.numberOfWorkers = numberOfWorkers
+        # Training data is generated on the fly and never stored.
+        self.streamingDataFlag = streamingDataFlag and (operatingMode == OperatingModes.TRAINING)
+        self.apgToleranceFlag = apgToleranceFlag
+        self.refineIterations = refineIterations
+        self.quantizeFlag = quantizeFlag
+        self.testBatchSize = testBatchSize
+        self.numberOfThreads = numberOfThreads
+        if numberOfThreads > 0:
+            torch.set_num_threads(numberOfThreads)
+        self.port = port
+        self.socketPort = socketPort
+        self.maxWait = maxWait  # in microseconds
         self.simulationId = simulationId
         
-        if (torch.cuda.is_available() and (not (self.operationMode==OperatingModes.TESTING))):
+        testingFlag = self.operationMode in [
+                                                OperatingModes.TESTING,
+                                                OperatingModes.BENCHMARK,
+                                                OperatingModes.SERVE,
+                                                OperatingModes.EXPORT
+                                            ]
+        if (torch.cuda.is_available() and (not testingFlag)):
             deviceTxt = "cuda"
         else:
             deviceTxt = "cpu"
@@ -75,10 +121,11 @@ class SimulationParameters:
         else:
             self.resultsBase = os.path.join(resultsBase, simIdName)
 
-        if self.operationMode == OperatingModes.TESTING:
-            handleDeletionAndCreation(self.resultsBase, forceRetain=True)
+        if testingFlag:
+            handleDeletionAndCreation(self.resultsBase, retain=True)
             
         self.modelFolderPath = self.resultsBase
+        self.exportFolder = os.path.join(self.resultsBase, "exported")
             
         self.dataFolder = os.path.join(self.baseFolderPath, "betas")
         self.validationDataFolder = os.path.join(self.baseFolderPath, "betasVal")
@@ -88,25 +135,29 @@ class SimulationParameters:
                 resTail = 'minK'
             self.resultsFolder = os.path.join(self.resultsBase, "results_"+ resTail)
             self.plotFolder = os.path.join(self.resultsBase, "plots_" + resTail)
+            self.benchmarkFolder = os.path.join(self.resultsBase, "benchmark_" + resTail)
         
 
-        if not self.operationMode == OperatingModes.PLOTTING_ONLY:
-            if not os.path.exists(self.baseFolderPath):
-                os.makedirs(self.baseFolderPath)
+        if self.operationMode in [OperatingModes.SERVE, OperatingModes.EXPORT]:
+            pass  # Only the trained models are used.
+        elif not self.operationMode == OperatingModes.PLOTTING_ONLY:
+            os.makedirs(self.baseFolderPath, exist_ok=True)
 
-            handleDeletionAndCreation(self.dataFolder, self.numberOfSamples, retain)
-            # The above function deletes and re-creates the folder only if retain=False.
-            # If we request different number of data samples than existing, then retain fails.
+            if not self.streamingDataFlag:
+                handleDeletionAndCreation(self.dataFolder, retain)
+                # The above function deletes and re-creates the folder only if retain=False.
+                # A retained folder is resumed or extended to the requested number of samples
+                # by generateData.
             
-            if not operatingMode==OperatingModes.TRAINING:
-                handleDeletionAndCreation(self.resultsFolder)
-                handleDeletionAndCreation(self.plotFolder, forceRetain= True)
-            else:
-                handleDeletionAndCreation(
-                                            self.validationDataFolder,
-                                            self.validationNumberOfData,
-                                            retain
-                                        )
+            if operatingMode==OperatingModes.BENCHMARK:
+                handleDeletionAndCreation(self.benchmarkFolder, retain=True)
+            elif not operatingMode==OperatingModes.TRAINING:
+                # A retained results folder is resumed by testAndPlot, computing only the samples
+                # and algos missing from it.
+                handleDeletionAndCreation(self.resultsFolder, retain)
+                handleDeletionAndCreation(self.plotFolder, retain=True)
+            elif not self.streamingDataFlag:
+                handleDeletionAndCreation(self.validationDataFolder, retain)
 
         else:
             if not os.path.exists(self.resultsFolder) or len(os.listdir(self.resultsFolder)) == 0:
@@ -114,15 +165,15 @@ class SimulationParameters:
                 print('Run TESTING mode before running PLOTTING_ONLY mode!')
                 sys.exit()
             
-            handleDeletionAndCreation(self.plotFolder, forceRetain= True)
+            handleDeletionAndCreation(self.plotFolder, retain=True)
 
         
         if not os.path.exists(self.modelFolderPath):
-            if self.operationMode == OperatingModes.TESTING:
+            if testingFlag:
                 print(self.modelFolderPath)
                 print('Train the neural network before testing!')
                 sys.exit()
-            os.makedirs(self.modelFolderPath)
+            os.makedirs(self.modelFolderPath, exist_ok=True)
         
     
     def handleModelSubFolders(self, modelsList):
@@ -133,7 +184,12 @@ class SimulationParameters:
             subfolderPath = os.path.join(self.modelFolderPath, modelName)
             self.modelSubfolderPathDict[modelName] = subfolderPath
             if not os.path.exists(subfolderPath):
-                if self.operationMode == OperatingModes.TESTING:
+                if self.operationMode in [
+                                            OperatingModes.TESTING,
+                                            OperatingModes.BENCHMARK,
+                                            OperatingModes.SERVE,
+                                            OperatingModes.EXPORT
+                                        ]:
                     print(subfolderPath)
                     print('Train the neural network before testing!')
                     sys.exit()
\ No newline at end of file
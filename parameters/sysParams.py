@@ -1,5 +1,6 @@
 import torch
 from .modes import OperatingModes
+from .geometry import loadGeometry
 
 
 class SystemParameters:
@@ -65,8 +66,8 @@ class SystemParameters:
         self.sigma_sh = 8  # in dB
         self.bandWidth = 20e6  # in Hz
         self.noiseFigure = 9  # in dB
-        self.zeta_d = 1  # in W
-        self.zeta_p = 0.2  # in W
+        zeta_d = 1  # in W
+        zeta_p = 0.2  # in W
         self.log_d0 = torch.log10(self.d0)
         self.log_d1 = torch.log10(self.d1)
         
@@ -74,10 +75,6 @@ class SystemParameters:
         
 
         self.No_Hz = -173.975
-        self.totalNoisePower = 10 ** ((self.No_Hz - 30) / 10) * self.bandWidth\
-            * 10 ** (self.noiseFigure / 10)
-        self.zeta_d /= self.totalNoisePower
-        self.zeta_p /= self.totalNoisePower
 
         self.Tp = 20
         self.Tc = 200
@@ -106,44 +103,37 @@ class SystemParameters:
         print(f"""Number of APs: {self.numberOfAccessPoints}
 Number of users: {self.maxNumberOfUsers}""")
 
-        torch.manual_seed(seed=0)
-        randomMat = torch.normal(0, 1, (self.Tp, self.Tp))
-        self.phiOrth, _, _ = torch.linalg.svd(randomMat)
-
-        areaDims = torch.tensor(
-                                    [self.areaWidth, self.areaHeight],
-                                    device=simulationParameters.device,
-                                    requires_grad=False,
-                                    dtype=torch.float32
+        # AP positions, pilot basis and normalized powers
+        geometry = loadGeometry(
+                                    simulationParameters.rootPath,
+                                    Tp=self.Tp,
+                                    numberOfAccessPoints=self.numberOfAccessPoints,
+                                    areaWidth=self.areaWidth.item(),
+                                    areaHeight=self.areaHeight.item(),
+                                    No_Hz=self.No_Hz,
+                                    bandWidth=self.bandWidth,
+                                    noiseFigure=self.noiseFigure,
+                                    zeta_d=zeta_d,
+                                    zeta_p=zeta_p,
                                 )
-        
-        torch.manual_seed(seed=2)
-        randVec = torch.rand(
-                                (2, self.numberOfAccessPoints),
-                                device=simulationParameters.device,
-                                requires_grad=False, dtype=torch.float32
-                            ) - 0.5  # 2 X M
-        
-        apPositions = torch.einsum('d,dm->md ', areaDims, randVec).to(simulationParameters.device)
-        
-        aw = self.areaWidth
-        ah = self.areaHeight
-        refList = [
-                        [  0,   0],
-                        [-aw,   0],
-                        [  0, -ah],
-                        [ aw,   0],
-                        [  0,  ah],
-                        [-aw,  ah],
-                        [ aw, -ah],
-                        [-aw, -ah],
-                        [ aw,  ah]
-                ]
-        ref = torch.tensor(
-                                refList,
-                                device=simulationParameters.device,
-                                requires_grad=False,
-                                dtype=torch.float32
-                        )
-        
-        self.apMinusRef = apPositions.view(-1, 1, 2)-ref
\ No newline at end of file
+        self.totalNoisePower = geometry['totalNoisePower']
+        self.zeta_d = geometry['zeta_d']
+        self.zeta_p = geometry['zeta_p']
+        self.phiOrth = geometry['phiOrth']
+        self.areaDims = geometry['areaDims'].to(simulationParameters.device)
+
+        # M X 2. The coverage area wraps around at its edges (see get_dMat).
+        self.apPositions = geometry['apPositions'].to(simulationParameters.device)
+
+    def getConstants(self):
+        # The constants the SEs of a power allocation depend on, besides the betas and pilots
+        return {
+                    'numberOfAccessPoints': self.numberOfAccessPoints,
+                    'maxNumberOfUsers': self.maxNumberOfUsers,
+                    'numberOfAntennas': self.numberOfAntennas,
+                    'Tp': self.Tp,
+                    'Tc': self.Tc,
+                    'tau': self.tau,
+                    'zeta_d': float(self.zeta_d),
+                    'zeta_p': float(self.zeta_p),
+                }
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import subprocess
+import torch
+from torch.utils.data import DataLoader
+
+from .testing import (
+    APG_TOLERANCE,
+    QUANTIZED_SUFFIX,
+    getAlgoList,
+    runPowerControlAlgos,
+    runPowerControlAlgosBatch,
+    setupAndLoadDeepLearningModels,
+)
+from .models.rootModel import RootDataset, PAD_CONST
+from utils.sampleStore import openSampleReader
+from utils.utils import getSystemInfo
+
+
+BENCHMARK_BATCH_SIZES = [1, 16, 128]  # 1 runs the algos sample by sample, as in testing
+BENCHMARK_WARMUP_RUNS = 3  # untimed runs before the trials of every algo and batch size
+BENCHMARK_TRIALS = 200  # with fewer than about 100 trials, p99 is just the slowest one
+BENCHMARK_PERCENTILES = [50, 90, 99]
+BENCHMARK_FORMAT_VERSION = 2
+
+
+def getGitCommit():
+    try:
+        return subprocess.run(
+                                ['git', 'rev-parse', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True,
+                                text=True,
+                                check=True
+                            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latencyStatistics(trialTimes, batchSize):
+    # trialTimes is a list of the batch latencies in seconds
+    trialTimes = torch.tensor(trialTimes, dtype=torch.float64)
+    statistics = {
+                    'batchLatencyMean': trialTimes.mean().item(),
+                    'sampleLatencyMean': trialTimes.mean().item() / batchSize,
+                    'throughput': batchSize / trialTimes.mean().item(),  # samples per second
+                }
+    for percentile in BENCHMARK_PERCENTILES:
+        batchLatency = torch.quantile(trialTimes, percentile / 100).item()
+        statistics[f'batchLatencyP{percentile}'] = batchLatency
+        statistics[f'sampleLatencyP{percentile}'] = batchLatency / batchSize
+    return statistics
+
+
+def loadBenchmarkBatches(simulationParameters, systemParameters, batchSize, numberOfBatches):
+    # The first numberOfBatches full batches of the test data, padded as in testInBatches
+    dataset = RootDataset(
+                            simulationParameters.dataFolder,
+                            simulationParameters.numberOfSamples,
+                            systemParameters.maxNumberOfUsers,
+                            PAD_CONST
+                        )
+    dataLoader = DataLoader(dataset, batch_size=batchSize, shuffle=False, drop_last=True)
+    batches = []
+    for batch in dataLoader:
+        if len(batches) == numberOfBatches:
+            break
+        batches.append(batch)
+    return batches
+
+
+def timeAlgo(
+                systemParameters,
+                algoName,
+                models,
+                sampleReader,
+                batches,
+                apgTolerance,
+                refineIterations,
+                device
+            ):
+    # Runs algoName BENCHMARK_WARMUP_RUNS + BENCHMARK_TRIALS times, cycling through the test samples
+    # (sampleReader) or the batches, and returns the latencies of the trials.
+    trialTimes = []
+    with torch.no_grad():
+        for run in range(BENCHMARK_WARMUP_RUNS + BENCHMARK_TRIALS):
+            if batches is None:
+                _, latencyDict, _ = runPowerControlAlgos(
+                                                            systemParameters,
+                                                            [algoName],
+                                                            models,
+                                                            sampleReader,
+                                                            run % len(sampleReader),
+                                                            apgTolerance,
+                                                            refineIterations
+                                                        )
+            else:
+                _, latencyDict, _ = runPowerControlAlgosBatch(
+                                                                systemParameters,
+                                                                [algoName],
+                                                                models,
+                                                                batches[run % len(batches)],
+                                                                apgTolerance,
+                                                                refineIterations,
+                                                                device
+                                                            )
+            if run >= BENCHMARK_WARMUP_RUNS:
+                trialTimes.append(latencyDict[algoName])
+    return trialTimes
+
+
+def benchmark(simulationParameters, systemParameters):
+    device = torch.device('cpu')  # The latencies are reported for the CPU, as in testing.
+    algoList, modelsList = getAlgoList(simulationParameters, systemParameters)
+    models = setupAndLoadDeepLearningModels(
+                                                modelsList,
+                                                simulationParameters,
+                                                systemParameters,
+                                                device,
+                                                simulationParameters.quantizeFlag
+                                            )
+    sampleReader = openSampleReader(simulationParameters.dataFolder)
+    apgTolerance = APG_TOLERANCE if simulationParameters.apgToleranceFlag else None
+    refineIterations = simulationParameters.refineIterations
+
+    results = []
+    for batchSize in BENCHMARK_BATCH_SIZES:
+        batches = None
+        if batchSize > 1:
+            batches = loadBenchmarkBatches(
+                                                simulationParameters,
+                                                systemParameters,
+                                                batchSize,
+                                                BENCHMARK_TRIALS
+                                            )
+            if len(batches) == 0:
+                print(f'Skipping the batch size {batchSize}: not enough test samples.')
+                continue
+
+        for algoName in algoList:
+            trialTimes = timeAlgo(
+                                    systemParameters,
+                                    algoName,
+                                    models,
+                                    sampleReader,
+                                    batches,
+                                    apgTolerance,
+                                    refineIterations,
+                                    device
+                                )
+            result = {'algo': algoName, 'batchSize': batchSize, 'trials': len(trialTimes), }
+            # runPowerControlAlgosBatch runs the quantized models sample by sample, so their
+            # batches are not run as one.
+            result['perSampleLoop'] = batchSize > 1 and algoName.endswith(QUANTIZED_SUFFIX)
+            result.update(latencyStatistics(trialTimes, batchSize))
+            results.append(result)
+
+    report = {
+                'version': BENCHMARK_FORMAT_VERSION,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'gitCommit': getGitCommit(),
+                'system': getSystemInfo(),
+                'torchVersion': torch.__version__,
+                'numberOfThreads': torch.get_num_threads(),
+                'warmupRuns': BENCHMARK_WARMUP_RUNS,
+                'scenario': simulationParameters.scenario,
+                'numberOfAccessPoints': systemParameters.numberOfAccessPoints,
+                'maxNumberOfUsers': systemParameters.maxNumberOfUsers,
+                'varyingNumberOfUsers': simulationParameters.varyingNumberOfUsersFlag,
+                'apgTolerance': apgTolerance,
+                'refineIterations': refineIterations,
+                'quantize': simulationParameters.quantizeFlag,
+                'latencyUnit': 'seconds',
+                'results': results,
+            }
+    reportPath = os.path.join(
+                                simulationParameters.benchmarkFolder,
+                                f'latency_threads{torch.get_num_threads()}.json'
+                            )
+    with open(reportPath, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    print(f'{"algo":>10}{"batch":>7}{"mean [ms]":>12}', end='')
+    for percentile in BENCHMARK_PERCENTILES:
+        print(f'{f"p{percentile} [ms]":>11}', end='')
+    print(f'{"samples/s":>12}')
+    for result in results:
+        perSampleLoopMark = '*' if result['perSampleLoop'] else ''
+        print(f'{result["algo"] + perSampleLoopMark:>10}{result["batchSize"]:>7}'
+              f'{1e3 * result["sampleLatencyMean"]:>12.3f}', end='')
+        for percentile in BENCHMARK_PERCENTILES:
+            print(f'{1e3 * result[f"sampleLatencyP{percentile}"]:>11.3f}', end='')
+        print(f'{result["throughput"]:>12.1f}')
+    print(f'Per-sample latencies. Saved the benchmark to {reportPath}')
+    if any(result['perSampleLoop'] for result in results):
+        print('* run sample by sample within the batch')
+    return report
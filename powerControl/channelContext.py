@@ -0,0 +1,135 @@
+import copy
+import torch
+
+from .utils import compute_v_matPilots, getPhiCrossMat, getPilotGroups, toGroups, toUsers
+from .utils import computeSmoothMin, seComputationCached, groupSeTerms
+from .gradientHandler import grad_fCached, grad_fPilotsCached
+
+
+# From this number of users on, the co-pilot group kernels (grad_fPilots) are used rather than the
+# dense K X K pilot structure (grad_f). See benchmarks/gradBenchmark.py.
+PILOT_GROUP_MIN_USERS = 160
+
+
+class ChannelContext:
+    # Everything Eq (5), (16), (17) and (42) need that depends only on the betas and the pilots,
+    # computed once per sample or batch and shared by all the power control algorithms and by the
+    # SE evaluation.
+    # betas b X M X K
+    # pilotSequences b X K pilot indices, utils.PILOT_PAD for the padded users
+    # With maskPaddedUsers, the padded users get no power and are left out of the utility and of
+    # the denominator of Eq (42), so that padding a sample does not change its utility or its
+    # gradient.
+
+    def __init__(self, betas, pilotSequences, systemParameters, maskPaddedUsers=False):
+        self.betas = betas
+        self.pilotSequences = pilotSequences
+        self.N = systemParameters.numberOfAntennas
+        self.zeta_d = systemParameters.zeta_d
+        self.Tp = systemParameters.Tp
+        self.Tc = systemParameters.Tc
+        self.tau = systemParameters.tau
+        self.device = betas.device
+
+        self.userMask = pilotSequences < self.Tp  # b X K
+        self.maskPaddedUsers = maskPaddedUsers
+        self.userWeights = None
+        if maskPaddedUsers:
+            self.userWeights = self.userMask.to(dtype=betas.dtype)
+
+        # Eq (5) b X M X K
+        self.vMat = compute_v_matPilots(betas, systemParameters.zeta_p, self.Tp, pilotSequences)
+        self.aMat = torch.sqrt(self.vMat) / betas  # b X M X K
+
+        self.pilotGroupsFlag = betas.shape[-1] >= PILOT_GROUP_MIN_USERS
+        if self.pilotGroupsFlag:
+            self.pilotGroups = getPilotGroups(pilotSequences, self.Tp)
+            self.betasGroups = toGroups(betas.transpose(1, 2), self.pilotGroups)  # b X Tp X G X M
+            self.aMatGroups = toGroups(self.aMat.transpose(1, 2), self.pilotGroups)
+        else:
+            # The pilots are orthonormal, so phiCrossMat ** 2 = phiCrossMat.
+            self.phiCrossMatSq = getPhiCrossMat(pilotSequences, self.Tp)  # b X K X K
+
+    def select(self, index):
+        # The context of the samples index of the batch
+        channelContext = copy.copy(self)
+        for name in ['betas', 'pilotSequences', 'userMask', 'userWeights', 'vMat', 'aMat',
+                     'betasGroups', 'aMatGroups', 'phiCrossMatSq']:
+            value = getattr(self, name, None)
+            if value is not None:
+                setattr(channelContext, name, value[index])
+        if self.pilotGroupsFlag:
+            channelContext.pilotGroups = tuple(x[index] for x in self.pilotGroups)
+        return channelContext
+
+    def maskMus(self, mus):
+        if self.maskPaddedUsers:
+            return mus * self.userMask.unsqueeze(1)
+        return mus
+
+    def se(self, mus):
+        # Eq (16) and (17), b X K. Padded users get an SE of 0.
+        mus = self.maskMus(mus)
+        if self.pilotGroupsFlag:
+            *_, SE = groupSeTerms(
+                                    self.betas,
+                                    self.betasGroups,
+                                    self.aMatGroups,
+                                    self.pilotGroups,
+                                    mus,
+                                    self.N,
+                                    self.zeta_d,
+                                    self.Tp,
+                                    self.Tc
+                                )
+            return toUsers(SE, self.pilotGroups) * self.userMask
+        return seComputationCached(
+                                    self.betas,
+                                    self.aMat,
+                                    self.phiCrossMatSq,
+                                    mus,
+                                    self.N,
+                                    self.zeta_d,
+                                    self.Tp,
+                                    self.Tc
+                                )
+
+    def utility(self, mus):
+        # Returns the smooth-min utility b and the SEs b X K
+        se = self.se(mus)
+        return [computeSmoothMin(se, self.tau, self.userWeights), se]
+
+    def grad(self, mus):
+        # Returns the gradient of Eq (42) b X M X K and the SEs b X K
+        mus = self.maskMus(mus)
+        if self.pilotGroupsFlag:
+            [grad, SE] = grad_fPilotsCached(
+                                        self.betas,
+                                        self.aMat,
+                                        self.betasGroups,
+                                        self.aMatGroups,
+                                        self.pilotGroups,
+                                        mus,
+                                        self.N,
+                                        self.zeta_d,
+                                        self.Tp,
+                                        self.Tc,
+                                        self.tau,
+                                        self.device,
+                                        userWeights=self.userWeights
+                                    )
+        else:
+            [grad, SE] = grad_fCached(
+                                self.betas,
+                                self.aMat,
+                                self.phiCrossMatSq,
+                                mus,
+                                self.N,
+                                self.zeta_d,
+                                self.Tp,
+                                self.Tc,
+                                self.tau,
+                                self.device,
+                                userWeights=self.userWeights
+                            )
+        return [self.maskMus(grad), SE]
@@ -0,0 +1,231 @@
+import os
+import json
+import importlib.util
+import inspect
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .utils import PILOT_PAD
+
+
+# Exported models of a simulation, in simIdX/exported:
+#   {model}.pt   : TorchScript module of DeployableModel, for any batch size and number of users
+#   {model}.onnx : ONNX model of DeployableModel for the maximum number of users, if onnx is
+#                  installed
+#   {model}.json : shapes, constants and equivalence check of the export
+# Loading them needs torch only, not pytorch_lightning or the model classes.
+EXPORT_CHECK_SAMPLES = 64  # test samples on which the exported and the trained models are compared
+EXPORT_TOLERANCE = 1e-5  # maximum absolute difference of their mus
+
+
+class ModelCore(nn.Module):
+    # The traced model with tensor arguments
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, logBetas, pilotSequences):
+        return self.model([logBetas, pilotSequences])
+
+
+class DeployableModel(nn.Module):
+    # deploy as a module. Takes the linear betas b X M X k and the pilot indices b X k, pads them
+    # to the maximum number of users, takes the log and returns the mus b X M X k of the model,
+    # which are already projected by project2s. The users with the pilot index PILOT_PAD are
+    # padded as well, so samples with different numbers of users can be batched.
+
+    def __init__(self, core, maxNumberOfUsers, Tp, padConst):
+        super().__init__()
+        self.core = core
+        self.maxNumberOfUsers = maxNumberOfUsers
+        self.Tp = Tp
+        self.padConst = padConst
+        self.pilotPad = float(PILOT_PAD)  # the padding value of F.pad is a float in TorchScript
+
+    def forward(self, betas, pilotSequences):
+        numberOfUsers = betas.shape[-1]
+        padUsers = self.maxNumberOfUsers - numberOfUsers
+        pilotSequences = pilotSequences.to(dtype=torch.uint8)
+        pilotSequences = F.pad(pilotSequences, [0, padUsers], 'constant', self.pilotPad)
+        betas = F.pad(betas.to(dtype=torch.float32), [0, padUsers], 'constant', self.padConst)
+        betas = torch.where((pilotSequences < self.Tp).unsqueeze(1), betas, self.padConst)
+
+        mus = self.core(torch.log(betas), pilotSequences)
+        return mus[:, :, :numberOfUsers]
+
+
+def loadExportedModel(exportFolder, modelName):
+    # Returns the TorchScript module of modelName and the description of its export
+    with open(os.path.join(exportFolder, f'{modelName}.json'), 'r') as file:
+        meta = json.load(file)
+    model = torch.jit.load(os.path.join(exportFolder, f'{modelName}.pt'), map_location='cpu')
+    return model.eval(), meta
+
+
+def getCheckSamples(simulationParameters, systemParameters):
+    # The first test samples, padded with PILOT_PAD and PAD_CONST beyond their number of users
+    from generateBetaAndPilots import SampleGenerator
+    from .models.rootModel import PAD_CONST
+    sampleGenerator = SampleGenerator(simulationParameters, systemParameters, 'testing')
+    betas, pilotSequences, numberOfUsers = sampleGenerator.generate(0, EXPORT_CHECK_SAMPLES)
+
+    userMask = torch.arange(betas.shape[-1]) < numberOfUsers.view(-1, 1)  # B X K
+    pilotSequences = torch.where(userMask, pilotSequences, PILOT_PAD)
+    betas = torch.where(userMask.unsqueeze(1), betas, PAD_CONST)
+    return betas.to(dtype=torch.float32), pilotSequences, numberOfUsers
+
+
+def checkExportedModel(model, exportedModel, modelName, samples):
+    # The maximum absolute difference between the mus of deploy and those of exportedModel, run
+    # sample by sample and on the whole padded batch
+    from .models.utils import deploy
+    betas, pilotSequences, numberOfUsers = samples
+    device = torch.device('cpu')
+    maxDifference = 0
+    with torch.no_grad():
+        batchMus = exportedModel(betas, pilotSequences)
+        for b in range(len(numberOfUsers)):
+            k = numberOfUsers[b]
+            sampleBetas, samplePilotSequences = betas[b:b + 1, :, :k], pilotSequences[b:b + 1, :k]
+            mus = deploy(model, sampleBetas, samplePilotSequences, modelName, device)
+            sampleMus = exportedModel(sampleBetas, samplePilotSequences)
+            maxDifference = max(
+                                    maxDifference,
+                                    (sampleMus - mus).abs().max().item(),
+                                    (batchMus[b:b + 1, :, :k] - mus).abs().max().item()
+                                )
+    return maxDifference
+
+
+def exportOnnx(model, filePath, samples, dynamo=None):
+    # Exports the untraced model for the maximum number of users and any batch size, with the
+    # dynamo exporter of torch.onnx if this torch has one (dynamo=None) and with the TorchScript
+    # one otherwise. Returns the maximum absolute difference between its mus and those of model on
+    # samples if onnxruntime is installed, and None otherwise.
+    betas, pilotSequences, _ = samples
+    pilotSequences = pilotSequences.to(dtype=torch.int64)
+    if dynamo is None:
+        dynamo = 'dynamo' in inspect.signature(torch.onnx.export).parameters
+    exportArguments = {'input_names': ['betas', 'pilotSequences'], 'output_names': ['mus'], }
+    if dynamo:
+        batchSize = torch.export.Dim('batchSize')
+        exportArguments.update(
+                                    dynamo=True,
+                                    dynamic_shapes={
+                                                        'betas': {0: batchSize},
+                                                        'pilotSequences': {0: batchSize},
+                                                    },
+                                    opset_version=18
+                                )
+    else:
+        exportArguments.update(
+                                    dynamic_axes={
+                                                    'betas': {0: 'batchSize'},
+                                                    'pilotSequences': {0: 'batchSize'},
+                                                    'mus': {0: 'batchSize'},
+                                                },
+                                    opset_version=17
+                                )
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            exportArguments['dynamo'] = False
+    torch.onnx.export(model, (betas, pilotSequences), filePath, **exportArguments)
+    if importlib.util.find_spec('onnxruntime') is None:
+        return None
+
+    import onnxruntime
+    session = onnxruntime.InferenceSession(filePath, providers=['CPUExecutionProvider'])
+    inputs = {'betas': betas.numpy(), 'pilotSequences': pilotSequences.numpy()}
+    [onnxMus] = session.run(None, inputs)
+    with torch.no_grad():
+        mus = model(betas, pilotSequences)
+    return (torch.from_numpy(onnxMus) - mus).abs().max().item()
+
+
+def exportModel(model, modelName, systemParameters, samples, exportFolder):
+    # Exports model as a TorchScript module (and an ONNX model) of DeployableModel once its mus
+    # match those of deploy on samples. Returns the description of the export, or None if they do
+    # not match.
+    from .models.rootModel import PAD_CONST
+
+    # The model is traced at the maximum number of users, the only one DeployableModel feeds it.
+    exampleInputs = [torch.log(samples[0][:2]), samples[1][:2].to(dtype=torch.uint8)]
+    with torch.no_grad():
+        core = ModelCore(model.to_torchscript(method='trace', example_inputs=(exampleInputs, )))
+    deployableModel = DeployableModel(
+                                        core,
+                                        systemParameters.maxNumberOfUsers,
+                                        systemParameters.Tp,
+                                        PAD_CONST
+                                    )
+    exportedModel = torch.jit.script(deployableModel)
+
+    maxDifference = checkExportedModel(model, exportedModel, modelName, samples)
+    print(f'{modelName}: maximum difference of the exported mus: {maxDifference:.2e}')
+    if maxDifference > EXPORT_TOLERANCE:
+        return None
+
+    filePath = os.path.join(exportFolder, f'{modelName}.pt')
+    torch.jit.save(exportedModel, filePath)
+
+    onnxFilePath = None
+    onnxMaxDifference = None
+    if importlib.util.find_spec('onnx') is None:
+        print('onnx is not installed. Skipping the ONNX export.')
+    else:
+        # The exporters of torch.onnx do not take the traced core, so they get the model itself.
+        onnxFilePath = os.path.join(exportFolder, f'{modelName}.onnx')
+        onnxModel = DeployableModel(
+                                        ModelCore(model),
+                                        systemParameters.maxNumberOfUsers,
+                                        systemParameters.Tp,
+                                        PAD_CONST
+                                    )
+        onnxMaxDifference = exportOnnx(onnxModel, onnxFilePath, samples)
+
+    meta = {
+                'model': modelName,
+                'numberOfAccessPoints': systemParameters.numberOfAccessPoints,
+                'maxNumberOfUsers': systemParameters.maxNumberOfUsers,
+                'Tp': systemParameters.Tp,
+                'pilotPad': PILOT_PAD,
+                'inputs': {
+                            'betas': 'b X M X K linear betas, float32',
+                            'pilotSequences': 'b X K pilot indices, pilotPad for padded users',
+                        },
+                'outputs': {'mus': 'b X M X K power coefficients'},
+                'torchScript': os.path.basename(filePath),
+                'onnx': None if onnxFilePath is None else os.path.basename(onnxFilePath),
+                'checkSamples': len(samples[2]),
+                'maxDifference': maxDifference,
+                'onnxMaxDifference': onnxMaxDifference,
+                'torchVersion': torch.__version__,
+            }
+    with open(os.path.join(exportFolder, f'{modelName}.json'), 'w') as file:
+        json.dump(meta, file, indent=1)
+    print(f'Exported {modelName} to {filePath}')
+    return meta
+
+
+def exportModels(simulationParameters, systemParameters):
+    # Exports every trained model of the simulation, see exportModel.
+    from .testing import setupAndLoadDeepLearningModels
+    from utils.utils import handleDeletionAndCreation
+    device = torch.device('cpu')
+
+    models = setupAndLoadDeepLearningModels(
+                                                systemParameters.models,
+                                                simulationParameters,
+                                                systemParameters,
+                                                device
+                                            )
+    samples = getCheckSamples(simulationParameters, systemParameters)
+    exportFolder = simulationParameters.exportFolder
+    handleDeletionAndCreation(exportFolder, retain=True)
+
+    for modelName, model in models.items():
+        if exportModel(model, modelName, systemParameters, samples, exportFolder) is None:
+            from sys import exit
+            print(f'The exported {modelName} does not match the trained model. Not exported.')
+            exit()
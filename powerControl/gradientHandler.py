@@ -1,6 +1,6 @@
 import torch
 
-from .utils import compute_v_mat, computeSmoothMin
+from .utils import computeSmoothMin, groupSeTerms, toGroups, toUsers
 
 
 def compute_num_k(betas, mus, N, zeta_d, Tp, Tc, vMat, phiCrossMat, k, tau):
@@ -41,8 +41,8 @@ def compute_num_k(betas, mus, N, zeta_d, Tp, Tc, vMat, phiCrossMat, k, tau):
     return num, se
 
 
-def grad_f(betas, mus, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
-    # Eq (42)
+def grad_fLoop(betas, mus, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
+    # Eq (42), one target user at a time. Reference implementation of grad_f.
     # v_mat b X M X K
     # phi_cross_mat b x K X K
     # betas b X M X K
@@ -71,25 +71,182 @@ def grad_f(betas, mus, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
     grad = num / den.view(-1, 1, 1)  # Eq (42) b X M X K
     return [grad, SE]
 
-def grads(betasIn, musIn, device, systemParameters, phiCrossMat):
+def grad_f(betas, mus, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device, chunkSize=None):
+    # Eq (42) for all the target users k at once. Same result as grad_fLoop.
+    # v_mat b X M X K
+    # phi_cross_mat b x K X K
+    # betas b X M X K
+    # mus b X M X K
+    aMat = torch.sqrt(vMat) / betas  # B X M X K
+    return grad_fCached(
+                            betas,
+                            aMat,
+                            phiCrossMat ** 2,
+                            mus,
+                            N,
+                            zeta_d,
+                            Tp,
+                            Tc,
+                            tau,
+                            device,
+                            chunkSize
+                        )
+
+def grad_fCached(
+                    betas,
+                    aMat,
+                    phiCrossMatSq,
+                    mus,
+                    N,
+                    zeta_d,
+                    Tp,
+                    Tc,
+                    tau,
+                    device,
+                    chunkSize=None,
+                    userWeights=None
+                ):
+    # grad_f on the mu-independent terms aMat = sqrt(vMat) / betas and phiCrossMat ** 2.
+    # With G[b, i, k] = sum_m aMat[b, m, i] * mus[b, m, i] * betas[b, m, k], nuDotMu of
+    # compute_num_k is phiCrossMat[:, i, k] * G[:, i, k], so the SE of every k follows from one
+    # B X K X K product, and the sum over k of the numerators collapses into two matrix products
+    # plus a diagonal correction.
+    # chunkSize limits the number of target users processed together (None for all of them), so
+    # the B X K X chunkSize intermediates can be kept small for large K.
+    # userWeights b X K weighs the users in the denominator of Eq (42) (None for all ones).
+    [B, M, K] = betas.shape
+    if chunkSize is None:
+        chunkSize = K
+
+    aMus = (aMat * mus).transpose(1, 2)  # B X K X M
+    # (zeta_d / N) * sum_i sum_m mus[b, m, i]^2 * betas[b, m, k]
+    powTerm = (zeta_d / N) * torch.einsum('bm,bmk->bk', (mus ** 2).sum(dim=2), betas)  # B X K
+
+    SE = torch.zeros((B, K), device=device, requires_grad=False, dtype=torch.float32)
+    num = torch.zeros((B, M, K), device=device, requires_grad=False, dtype=torch.float32)
+    betaDotC = torch.zeros((B, M), device=device, requires_grad=False, dtype=torch.float32)
+
+    for start in range(0, K, chunkSize):
+        ks = slice(start, min(start + chunkSize, K))
+        betas_ks = betas[:, :, ks]  # B X M X C
+        phiCrossMatSq_ks = phiCrossMatSq[:, :, ks]  # B X K X C
+
+        G = aMus @ betas_ks  # B X K X C
+        bMat = zeta_d * phiCrossMatSq_ks * G**2  # B X K X C, bVec of compute_num_k per column
+        b_plus_c = 1 / (N ** 2) + powTerm[:, ks] + bMat.sum(dim=1)  # B X C
+        b = torch.diagonal(bMat[:, ks], dim1=1, dim2=2)  # B X C
+        gamma = b / (b_plus_c - b)
+        se = (1 - Tp / Tc) * torch.log(1 + gamma)  # B X C
+        SE[:, ks] = se
+
+        weight = torch.exp(-tau * se)
+        invInterference = 1 / (b_plus_c - b)
+        c = weight * (1 / b_plus_c - invInterference)  # B X C
+
+        # Terms of all the users i: (temp1Batch + temp2Batch) * (1/b_plus_c - 1/(b_plus_c - b))
+        weightedG = (c.unsqueeze(1) * phiCrossMatSq_ks * G).transpose(1, 2)  # B X C X K
+        num += 2 * zeta_d * aMat * (betas_ks @ weightedG)
+        betaDotC += torch.einsum('bmc,bc->bm', betas_ks, c)
+
+        # Term of the target user i = k: temp1Batch[:, :, k] / (b_plus_c - b)
+        diagTerm = weight * invInterference\
+            * torch.diagonal(phiCrossMatSq_ks[:, ks] * G[:, ks], dim1=1, dim2=2)  # B X C
+        num[:, :, ks] += 2 * zeta_d * aMat[:, :, ks] * betas_ks * diagTerm.unsqueeze(1)
+
+    num += 2 * (zeta_d / N) * mus * betaDotC.unsqueeze(2)
+
+    den = torch.exp(-tau * SE)
+    if userWeights is not None:
+        den = den * userWeights
+    den = den.sum(dim=1)  # b X 1
+    grad = num / den.view(-1, 1, 1)  # Eq (42) b X M X K
+    return [grad, SE]
+
+def grad_fPilots(betas, mus, N, zeta_d, Tp, Tc, pilotGroups, vMat, tau, device):
+    # Eq (42) per co-pilot group (see utils.getPilotGroups), at a cost of O(B M K G) instead of
+    # O(B M K^2). Same result as grad_f with the phiCrossMat of the same pilots.
+    # pilotGroups from utils.getPilotGroups
+    # v_mat b X M X K
+    # betas b X M X K
+    # mus b X M X K
+    aMat = torch.sqrt(vMat) / betas  # b X M X K
+    return grad_fPilotsCached(
+                                betas,
+                                aMat,
+                                toGroups(betas.transpose(1, 2), pilotGroups),
+                                toGroups(aMat.transpose(1, 2), pilotGroups),
+                                pilotGroups,
+                                mus,
+                                N,
+                                zeta_d,
+                                Tp,
+                                Tc,
+                                tau,
+                                device
+                            )
+
+def grad_fPilotsCached(
+                        betas,
+                        aMat,
+                        betasGroups,
+                        aMatGroups,
+                        pilotGroups,
+                        mus,
+                        N,
+                        zeta_d,
+                        Tp,
+                        Tc,
+                        tau,
+                        device,
+                        userWeights=None
+                    ):
+    # grad_fPilots on the mu-independent terms aMat = sqrt(vMat) / betas and the grouped
+    # betasGroups, aMatGroups b X Tp X G X M (see utils.toGroups).
+    # userWeights b X K weighs the users in the denominator of Eq (42) (None for all ones).
+    G, b_plus_c, b, seGroups = groupSeTerms(
+                                                betas,
+                                                betasGroups,
+                                                aMatGroups,
+                                                pilotGroups,
+                                                mus,
+                                                N,
+                                                zeta_d,
+                                                Tp,
+                                                Tc
+                                            )  # G b X Tp X G X G, rest b X Tp X G
+    userMask = pilotGroups[3]
+    weight = torch.exp(-tau * seGroups)
+    invInterference = 1 / (b_plus_c - b)
+    c = weight * (1 / b_plus_c - invInterference)  # b X Tp X G, 0 in the empty slots
+
+    # Co-pilot terms: sum over the users h in the group of user g
+    coPilotTerm = (G * c.unsqueeze(2)) @ betasGroups  # b X Tp X G X M
+    # Term of the target user itself
+    selfTerm = weight * invInterference * torch.diagonal(G, dim1=2, dim2=3)  # b X Tp X G
+
+    coPilotTerm = toUsers(coPilotTerm, pilotGroups).transpose(1, 2)  # b X M X K
+    selfTerm = toUsers(selfTerm, pilotGroups) * userMask  # b X K
+    num = 2 * zeta_d * aMat * (coPilotTerm * userMask.unsqueeze(1) + betas * selfTerm.unsqueeze(1))
+    betaDotC = betas @ (toUsers(c, pilotGroups) * userMask).unsqueeze(2)  # b X M X 1
+    num += 2 * (zeta_d / N) * mus * betaDotC
+
+    # Padded users have an SE of 0 and, unless userWeights says otherwise, still count in the
+    # denominator, as in grad_f.
+    SE = toUsers(seGroups, pilotGroups) * userMask
+    den = torch.exp(-tau * SE)
+    if userWeights is not None:
+        den = den * userWeights
+    den = den.sum(dim=1)  # b X 1
+    grad = num / den.view(-1, 1, 1)  # Eq (42) b X M X K
+    return [grad, SE]
+
+def grads(betasIn, musIn, device, systemParameters, pilotSequences):
+    # pilotSequences b X K pilot indices, utils.PILOT_PAD for the padded users
+    from .channelContext import ChannelContext
     with torch.no_grad():
-        tau = systemParameters.tau
-        
-        # Eq (5) b X M X K
-        vMat = compute_v_mat(betasIn, systemParameters.zeta_p, systemParameters.Tp, phiCrossMat)
-        [musOut, se] = grad_f(
-                                    betasIn,
-                                    musIn,
-                                    systemParameters.numberOfAntennas,
-                                    systemParameters.zeta_d,
-                                    systemParameters.Tp,
-                                    systemParameters.Tc,
-                                    phiCrossMat,
-                                    vMat,
-                                    tau,
-                                    device
-                                )  # [b X M X K, b X K]
+        channelContext = ChannelContext(betasIn, pilotSequences, systemParameters)
+        [musOut, se] = channelContext.grad(musIn)  # [b X M X K, b X K]
         
         musOut= -musOut  # Reason: gradient of loss = - gradient of utility
-        utility = computeSmoothMin(se, tau)  # b X 1
+        utility = computeSmoothMin(se, systemParameters.tau)  # b X 1
         return [musOut, utility]
\ No newline at end of file
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
-import os
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
 import pytorch_lightning as pl
@@ -9,41 +8,96 @@ import math
 import torch.nn.functional as F
 from math import sqrt
 
+from utils.sampleStore import openSampleReader
+from powerControl.utils import PILOT_PAD
+
+
+PAD_CONST = 6e-13  # betas of the padded users
+
 
 class RootDataset(Dataset):
-    def __init__(self, dataPath, phiOrth, numSamples, maxNumberOfUsers, PAD_CONST):
+    def __init__(self, dataPath, numSamples, maxNumberOfUsers, PAD_CONST):
         self.path = dataPath
-        _, _, files = next(os.walk(self.path))
-        self.numSamples = min(len(list(filter(lambda k: 'betas' in k, files))), numSamples)
-        self.phiOrth = phiOrth
+        self.sampleReader = openSampleReader(self.path)
+        self.numSamples = min(len(self.sampleReader), numSamples)
         self.maxNumberOfUsers = maxNumberOfUsers
         self.PAD_CONST = PAD_CONST
         
     def __getitem__(self, index):
-        betaFileName = f'betasSample{index}.pt'
-        betaFilePath = os.path.join(self.path, betaFileName)
-        m = torch.load(betaFilePath)
-        betaOriginal = m['betas'].to(dtype=torch.float32)
-        pilotSequence = m['pilotSequence'].to(dtype=torch.int32)
-
-        phi = torch.index_select(self.phiOrth, 0, pilotSequence)
-        phiCrossMat = torch.abs(phi.conj() @ phi.T)
-        
-        actualNumberOfUsers = phiCrossMat.size(-1)
-        padUsers = self.maxNumberOfUsers - actualNumberOfUsers
-        phiCrossMatPadded = F.pad(phiCrossMat, (0, padUsers, 0, padUsers), 'constant', 0)
-        betaOriginalPadded = F.pad(betaOriginal, (0, padUsers, 0, 0), 'constant', self.PAD_CONST)
-        
-        betaTorch = torch.log(betaOriginalPadded)
+        # The betas are decoded straight into the log domain. The training and validation steps
+        # recover the linear betas of the whole batch at once. The pilot structure is carried as
+        # the pilot indices and expanded on the device.
+        betaTorch, pilotSequence = self.sampleReader.getLogSample(index)
         betaTorch = betaTorch.to(dtype=torch.float32)
-        betaTorch = betaTorch.reshape(betaOriginalPadded.shape)
+        pilotSequence = pilotSequence.to(dtype=torch.uint8)
 
-        return phiCrossMatPadded, betaTorch, betaOriginalPadded, actualNumberOfUsers
+        actualNumberOfUsers = pilotSequence.size(-1)
+        padUsers = self.maxNumberOfUsers - actualNumberOfUsers
+        pilotSequencePadded = F.pad(pilotSequence, (0, padUsers), 'constant', PILOT_PAD)
+        betaTorch = F.pad(betaTorch, (0, padUsers, 0, 0), 'constant', math.log(self.PAD_CONST))
+
+        return pilotSequencePadded, betaTorch, actualNumberOfUsers
 
     def __len__(self):
         return self.numSamples
 
 
+class StreamingDataset(IterableDataset):
+    # Generates the samples on the fly, batch by batch, inside the DataLoader workers.
+    # Epoch e yields the samples e * numSamples, ..., (e + 1) * numSamples - 1 of sampleGenerator,
+    # so every epoch sees fresh samples and every run sees the same ones.
+    def __init__(
+                    self,
+                    sampleGenerator,
+                    numSamples,
+                    maxNumberOfUsers,
+                    PAD_CONST,
+                    batchSize,
+                    freshSamplesPerEpoch=True
+                ):
+        self.sampleGenerator = sampleGenerator
+        self.numSamples = numSamples
+        self.maxNumberOfUsers = maxNumberOfUsers
+        self.PAD_CONST = PAD_CONST
+        self.batchSize = batchSize
+        self.freshSamplesPerEpoch = freshSamplesPerEpoch
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        workerInfo = get_worker_info()
+        workerId, numberOfWorkers = 0, 1
+        if workerInfo is not None:
+            workerId, numberOfWorkers = workerInfo.id, workerInfo.num_workers
+        epochStart = self.epoch * self.numSamples if self.freshSamplesPerEpoch else 0
+
+        # The DataLoader fetches from the workers in turn, so the batches come out in order.
+        batchStarts = range(0, self.numSamples, self.batchSize)
+        for batchStart in batchStarts[workerId::numberOfWorkers]:
+            count = min(self.batchSize, self.numSamples - batchStart)
+            betas, pilotSequences, numberOfUsers = self.sampleGenerator.generate(
+                                                                        epochStart + batchStart,
+                                                                        count
+                                                                    )
+            yield self.prepareBatch(betas, pilotSequences, numberOfUsers)
+
+    def prepareBatch(self, betaOriginal, pilotSequences, actualNumberOfUsers):
+        # Batched version of RootDataset.__getitem__ followed by the default collation
+        userMask = torch.arange(self.maxNumberOfUsers) < actualNumberOfUsers.view(-1, 1)  # B X K
+
+        pilotSequencesPadded = torch.where(userMask, pilotSequences, PILOT_PAD)
+        pilotSequencesPadded = pilotSequencesPadded.to(dtype=torch.uint8)
+        betaOriginalPadded = torch.where(userMask.unsqueeze(1), betaOriginal, self.PAD_CONST)
+
+        betaTorch = torch.log(betaOriginalPadded)
+        return pilotSequencesPadded, betaTorch, actualNumberOfUsers
+
+    def __len__(self):
+        return (self.numSamples + self.batchSize - 1) // self.batchSize
+
+
 class CommonParameters:
     numSamples = 1
     batchSize = 1024
@@ -65,6 +119,15 @@ class CommonParameters:
         cls.trainingDataPath = simulationParameters.dataFolder
         cls.validationDataPath = simulationParameters.validationDataFolder
         cls.scenario = simulationParameters.scenario
+        cls.validationNumberOfData = simulationParameters.validationNumberOfData
+        cls.numberOfWorkers = simulationParameters.numberOfWorkers
+        cls.streamingDataFlag = simulationParameters.streamingDataFlag
+        if cls.streamingDataFlag:
+            from generateBetaAndPilots import SampleGenerator
+            cls.sampleGenerators = {
+                split: SampleGenerator(simulationParameters, systemParameters, split)
+                for split in ['training', 'validation']
+            }
         
         warmupSteps = 4000
         scaleFactor = 1
@@ -109,15 +172,16 @@ class RootNet(pl.LightningModule):
         self.relu = nn.ReLU()
         self.name = None
         self.maxNumberOfUsers = self.systemParameters.maxNumberOfUsers
-        self.PAD_CONST = 6e-13
+        self.PAD_CONST = PAD_CONST
         
     
     def training_step(self, batch, batch_idx):
         opt = self.optimizers()
-        phiCrossMat, betaTorch, betaOriginal, _ = batch
+        pilotSequences, betaTorch, _ = batch
+        betaOriginal = torch.exp(betaTorch)
 
         opt.zero_grad()
-        mus = self([betaTorch, phiCrossMat])
+        mus = self([betaTorch, pilotSequences])
 
         with torch.no_grad():
             [mus_grads, utility] = self.grads(
@@ -125,7 +189,7 @@ class RootNet(pl.LightningModule):
                                                     mus,
                                                     self.device,
                                                     self.systemParameters,
-                                                    phiCrossMat
+                                                    pilotSequences
                                             )
         
         self.manual_backward(mus, None, gradient=mus_grads)
@@ -142,16 +206,17 @@ class RootNet(pl.LightningModule):
     
 
     def validation_step(self, batch, batch_idx):
-        phiCrossMat, betaTorch, betaOriginal, _ = batch
+        pilotSequences, betaTorch, _ = batch
+        betaOriginal = torch.exp(betaTorch)
 
-        mus = self([betaTorch, phiCrossMat])
+        mus = self([betaTorch, pilotSequences])
 
         [_, utility] = self.grads(
                                         betaOriginal,
                                         mus,
                                         self.device,
                                         self.systemParameters,
-                                        phiCrossMat
+                                        pilotSequences
                                 )
         loss = -utility.mean()
         self.log('valLoss', loss, on_step=True, on_epoch=True, prog_bar=True)
@@ -179,10 +244,34 @@ class RootNet(pl.LightningModule):
                                         )
             return optimizer
     
+    def on_train_epoch_start(self):
+        # Runs before the training DataLoader iterator (and its workers) of the epoch is created.
+        if self.streamingDataFlag:
+            self.trainDataset.set_epoch(self.current_epoch)
+
+    def getStreamingDataLoader(self, split, numSamples, freshSamplesPerEpoch):
+        dataset = StreamingDataset(
+                                        sampleGenerator=self.sampleGenerators[split],
+                                        numSamples=numSamples,
+                                        maxNumberOfUsers = self.maxNumberOfUsers,
+                                        PAD_CONST = self.PAD_CONST,
+                                        batchSize=self.batchSize,
+                                        freshSamplesPerEpoch=freshSamplesPerEpoch,
+                                    )
+        numberOfWorkers = self.numberOfWorkers if self.numberOfWorkers > 1 else 0
+        return dataset, DataLoader(dataset=dataset, batch_size=None, num_workers=numberOfWorkers)
+
     def train_dataloader(self):
+        if self.streamingDataFlag:
+            self.trainDataset, trainLoader = self.getStreamingDataLoader(
+                                                                            'training',
+                                                                            self.numSamples,
+                                                                            True
+                                                                        )
+            return trainLoader
+
         trainDataset = self.InpDataset(
                                             dataPath=self.dataPath,
-                                            phiOrth=self.systemParameters.phiOrth,
                                             numSamples=self.numSamples,
                                             maxNumberOfUsers = self.maxNumberOfUsers,
                                             PAD_CONST = self.PAD_CONST,
@@ -191,9 +280,17 @@ class RootNet(pl.LightningModule):
         return trainLoader
 
     def val_dataloader(self):
+        if self.streamingDataFlag:
+            # The validation samples are the same in every epoch.
+            _, valLoader = self.getStreamingDataLoader(
+                                                            'validation',
+                                                            self.validationNumberOfData,
+                                                            False
+                                                        )
+            return valLoader
+
         valDataset = self.InpDataset(
                                         dataPath=self.valDataPath,
-                                        phiOrth=self.systemParameters.phiOrth,
                                         numSamples=self.numSamples,
                                         maxNumberOfUsers = self.maxNumberOfUsers,
                                         PAD_CONST = self.PAD_CONST,
@@ -49,6 +49,11 @@ class NeuralNet(RootNet):
         self.learningRate = HyperParameters.learningRate
         self.VARYING_STEP_SIZE = HyperParameters.VARYING_STEP_SIZE
         self.lambdaLr = HyperParameters.lambdaLr
+        self.streamingDataFlag = HyperParameters.streamingDataFlag
+        self.numberOfWorkers = HyperParameters.numberOfWorkers
+        self.validationNumberOfData = HyperParameters.validationNumberOfData
+        if self.streamingDataFlag:
+            self.sampleGenerators = HyperParameters.sampleGenerators
         
         
         self.inputSize = HyperParameters.inputSize
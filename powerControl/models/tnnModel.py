@@ -5,6 +5,7 @@ import torch.nn as nn
 from .rootModel import CommonParameters, RootNet
 from .utils import EncoderLayer, Norm
 from powerControl.testing import project2s
+from powerControl.utils import getPhiCrossMat
 
 
 MODEL_NAME = 'TNN'
@@ -43,6 +44,11 @@ class NeuralNet(RootNet):
         self.learningRate = HyperParameters.learningRate
         self.VARYING_STEP_SIZE = HyperParameters.VARYING_STEP_SIZE
         self.lambdaLr = HyperParameters.lambdaLr
+        self.streamingDataFlag = HyperParameters.streamingDataFlag
+        self.numberOfWorkers = HyperParameters.numberOfWorkers
+        self.validationNumberOfData = HyperParameters.validationNumberOfData
+        if self.streamingDataFlag:
+            self.sampleGenerators = HyperParameters.sampleGenerators
         
         heads = HyperParameters.heads
         M2 = HyperParameters.M2
@@ -60,8 +66,9 @@ class NeuralNet(RootNet):
 
 
     def forward(self, input):
-        x, phiCrossMat = input
-        mask = torch.unsqueeze(phiCrossMat**2, dim=1)
+        x, pilotSequences = input
+        # Users attend to the users sharing their pilot
+        mask = torch.unsqueeze(getPhiCrossMat(pilotSequences, self.systemParameters.Tp), dim=1)
         x = x.transpose(1,2).contiguous()
         x = self.norm1(x)
         x = self.inpMapping(x)
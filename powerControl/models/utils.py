@@ -1,3 +1,5 @@
+import hashlib
+import io
 import os
 import torch
 import torch.nn as nn
@@ -18,16 +20,24 @@ def initializeWeights(m):
         nn.init.constant_(m.bias.data, 0)
 
 
-def deploy(model, testSample, phiCrossMat, modelName, device):
+def deploy(model, testSample, pilotSequences, modelName, device):
+    # testSample 1 X M X K betas and pilotSequences 1 X K pilot indices
+    # The model is expected to be in eval mode and on device already.
+    from powerControl.utils import PILOT_PAD
     importPath = findImportPath(modelName)
     # module = importlib.import_module(importPath, ".")  # imports the scenarios
     
     
 
     with torch.no_grad():
-        actualNumberOfUsers = phiCrossMat.size(-1)
+        actualNumberOfUsers = pilotSequences.size(-1)
         padUsers = model.maxNumberOfUsers - actualNumberOfUsers
-        phiCrossMatPadded = F.pad(phiCrossMat, (0, padUsers, 0, padUsers), 'constant', 0)
+        pilotSequencesPadded = F.pad(
+                                        pilotSequences.to(dtype=torch.uint8),
+                                        (0, padUsers),
+                                        'constant',
+                                        PILOT_PAD
+                                    )
         testSample = F.pad(testSample, (0, padUsers, 0, 0), 'constant', model.PAD_CONST)
         
         testSample = torch.log(testSample)
@@ -35,19 +45,32 @@ def deploy(model, testSample, phiCrossMat, modelName, device):
         testSample = testSample.reshape((1,-1)).to(device='cpu')
         testSample.requires_grad=False
         testSample = testSample.to(device=device, dtype=torch.float32).view(testSampleShape)
-        model.eval()
-        model.to(device=device)
         
-        mus_predicted = model(
-                                    [
-                                        testSample,
-                                        phiCrossMatPadded.to(device=device, dtype=torch.float32)
-                                    ]
-                            )
+        mus_predicted = model([testSample, pilotSequencesPadded.to(device=device)])
         
         mus_predicted = mus_predicted[:,:,:actualNumberOfUsers]
         return mus_predicted
 
+def quantizeModel(model):
+    # Post-training dynamic quantization for the CPU: the weights of the nn.Linear layers are
+    # stored in int8 and their activations are quantized on the fly. Returns a quantized copy.
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def checkpointHash(checkpointPath):
+    # Hash of the content of a checkpoint file, the same for its copies in other folders
+    with open(checkpointPath, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:16]
+
+
+def modelSize(model):
+    # Size of the serialized state_dict of model in bytes
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
 def initializeHyperParams(modelName, simulationParameters, systemParameters):
     # Ex: If model_name is 'TNN', it imports TNN_model module and initializes its hyper parameters.
     importPath = findImportPath(modelName)
@@ -80,6 +103,7 @@ def loadTheLatestModelAndParamsIfExists(
                                                                 system_parameters=systemParameters,
                                                                 grads=grads
                                                         )
+            model.checkpointPath = modelFilePath  # identifies the trained model in the results
         else:
             from sys import exit
             print({modelFolder})
@@ -0,0 +1,354 @@
+import json
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .channelContext import ChannelContext
+from .models.rootModel import PAD_CONST
+from .testing import LOG_CONVERSION_CONST, setupAndLoadDeepLearningModels
+from .utils import PILOT_PAD
+
+
+SERVE_HOST = '127.0.0.1'  # the server only accepts local connections
+SERVE_MAX_BATCH_SIZE = 128  # requests run together at most
+
+# Binary socket protocol, little-endian. Every message starts with its length in bytes, not
+# counting the length itself (MESSAGE_LENGTH).
+#   request : model index (uint8, the position of the model in GET /info), K (uint16), the
+#             M X K betas (float32, row-major, linear scale) and the K pilot indices (uint8)
+#   response: status (uint8) and, if it is SOCKET_OK, the M X K mus and the K SEs in
+#             bits/sec/Hz (float32), and otherwise the UTF-8 error message
+MESSAGE_LENGTH = struct.Struct('<I')
+SOCKET_REQUEST_HEADER = struct.Struct('<BH')
+SOCKET_OK = 0
+SOCKET_BAD_REQUEST = 1
+SOCKET_SERVER_ERROR = 2
+
+
+class PowerControlRequest:
+
+    def __init__(self, modelName, betas, pilotSequence):
+        self.modelName = modelName
+        self.betas = betas  # M X K
+        self.pilotSequence = pilotSequence  # K
+        self.done = threading.Event()
+        self.mus = None
+        self.se = None
+        self.error = None
+
+
+class MicroBatcher:
+    # Queues the requests of the server threads and runs them in one worker thread. The requests
+    # arriving within maxWait seconds of the first one of a batch, up to maxBatchSize of them, are
+    # padded and run together, one model at a time.
+
+    def __init__(self, models, systemParameters, maxWait, maxBatchSize=SERVE_MAX_BATCH_SIZE):
+        self.models = models
+        self.systemParameters = systemParameters
+        self.maxWait = maxWait
+        self.maxBatchSize = maxBatchSize
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        # Blocks until the request is answered
+        self.requests.put(request)
+        request.done.wait()
+        return request
+
+    def collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.maxWait
+        while len(batch) < self.maxBatchSize:
+            try:
+                timeout = deadline - time.perf_counter()
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            for modelName in {request.modelName for request in batch}:
+                requests = [request for request in batch if request.modelName == modelName]
+                try:
+                    self.runModel(modelName, requests)
+                except Exception as error:
+                    for request in requests:
+                        request.error = repr(error)
+                for request in requests:
+                    request.done.set()
+
+    def runModel(self, modelName, requests):
+        # Pads the requests to the maximum number of users, as RootDataset does
+        maxNumberOfUsers = self.systemParameters.maxNumberOfUsers
+        betas = []
+        pilotSequences = []
+        for request in requests:
+            padUsers = maxNumberOfUsers - request.pilotSequence.shape[-1]
+            betas.append(F.pad(request.betas, (0, padUsers), 'constant', PAD_CONST))
+            pilotSequence = F.pad(request.pilotSequence, (0, padUsers), 'constant', PILOT_PAD)
+            pilotSequences.append(pilotSequence)
+        betas = torch.stack(betas)  # b X M X K
+        pilotSequences = torch.stack(pilotSequences)  # b X K
+
+        with torch.no_grad():
+            mus = self.models[modelName]([torch.log(betas), pilotSequences])
+            channelContext = ChannelContext(
+                                                betas,
+                                                pilotSequences,
+                                                self.systemParameters,
+                                                maskPaddedUsers=True
+                                            )
+            se = channelContext.se(mus)*LOG_CONVERSION_CONST
+
+        for index, request in enumerate(requests):
+            numberOfUsers = request.betas.shape[-1]
+            request.mus = mus[index, :, :numberOfUsers]
+            request.se = se[index, :numberOfUsers]
+
+
+def makePowerControlRequest(modelName, betas, pilotSequence, models, systemParameters):
+    # betas M X K (float32) and pilotSequence K (int64) of a request. Raises ValueError if they are
+    # not valid.
+    if modelName not in models:
+        raise ValueError(f'Unknown model {modelName}. Choose one of {list(models)}.')
+    numberOfAccessPoints = systemParameters.numberOfAccessPoints
+    if betas.dim() != 2 or betas.shape[0] != numberOfAccessPoints:
+        raise ValueError(f'betas must be a {numberOfAccessPoints} X K list.')
+    if not 0 < betas.shape[1] <= systemParameters.maxNumberOfUsers:
+        raise ValueError(f'The number of users must be in 1, ..., '
+                         f'{systemParameters.maxNumberOfUsers}.')
+    if not (betas > 0).all():
+        raise ValueError('betas must be positive.')
+    if pilotSequence.shape != (betas.shape[1],):
+        raise ValueError('pilotSequence must hold one pilot index per user.')
+    if not ((0 <= pilotSequence) & (pilotSequence < systemParameters.Tp)).all():
+        raise ValueError(f'The pilot indices must be in 0, ..., {systemParameters.Tp - 1}.')
+    return PowerControlRequest(modelName, betas, pilotSequence.to(dtype=torch.uint8))
+
+
+def parsePowerControlRequest(body, models, systemParameters):
+    # body is the JSON object {"model": "TNN", "betas": M X K list, "pilotSequence": K list} of the
+    # large-scale fading coefficients (linear scale) and the pilot indices of a channel
+    # realization. Raises ValueError if it is not valid.
+    modelName = body.get('model', next(iter(models)))
+    pilotSequence = body['pilotSequence']
+    # torch.tensor would truncate 1.7 to the pilot 1 and take true as the pilot 1.
+    if not isinstance(pilotSequence, list) or not all(
+            isinstance(pilot, int) and not isinstance(pilot, bool) for pilot in pilotSequence):
+        raise ValueError('pilotSequence must be a list of integer pilot indices.')
+    return makePowerControlRequest(
+                                        modelName,
+                                        torch.tensor(body['betas'], dtype=torch.float32),
+                                        torch.tensor(pilotSequence, dtype=torch.int64),
+                                        models,
+                                        systemParameters
+                                    )
+
+
+def parseSocketRequest(message, models, systemParameters):
+    # message is a request of the binary socket protocol without its length. Raises ValueError if
+    # it is not valid.
+    if len(message) < SOCKET_REQUEST_HEADER.size:
+        raise ValueError('The request is shorter than its header.')
+    modelIndex, numberOfUsers = SOCKET_REQUEST_HEADER.unpack_from(message)
+    numberOfBetas = systemParameters.numberOfAccessPoints * numberOfUsers
+    if len(message) != SOCKET_REQUEST_HEADER.size + 4*numberOfBetas + numberOfUsers:
+        raise ValueError(f'A request of {numberOfUsers} users must hold '
+                         f'{systemParameters.numberOfAccessPoints} X {numberOfUsers} float32 betas '
+                         f'and {numberOfUsers} uint8 pilot indices.')
+    modelNames = list(models)
+    if modelIndex >= len(modelNames):
+        raise ValueError(f'Unknown model index {modelIndex}. Models: {modelNames}.')
+
+    offset = SOCKET_REQUEST_HEADER.size
+    betas = np.frombuffer(message, dtype='<f4', count=numberOfBetas, offset=offset)
+    pilotSequence = np.frombuffer(
+                                    message,
+                                    dtype=np.uint8,
+                                    count=numberOfUsers,
+                                    offset=offset + 4*numberOfBetas
+                                )
+    return makePowerControlRequest(
+                                        modelNames[modelIndex],
+                                        torch.from_numpy(betas.copy()).view(-1, numberOfUsers),
+                                        torch.from_numpy(pilotSequence.astype(np.int64)),
+                                        models,
+                                        systemParameters
+                                    )
+
+
+def makeRequestHandler(microBatcher, models, systemParameters):
+
+    class PowerControlRequestHandler(BaseHTTPRequestHandler):
+        # Keeps the connections open between requests and sends the replies without delay
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def reply(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path != '/info':
+                self.reply(404, {'error': 'GET /info or POST /powerControl'})
+                return
+            self.reply(200, {
+                                'models': list(models),
+                                'numberOfAccessPoints': systemParameters.numberOfAccessPoints,
+                                'maxNumberOfUsers': systemParameters.maxNumberOfUsers,
+                                'numberOfPilots': systemParameters.Tp,
+                                'seUnit': 'bits/sec/Hz',
+                            })
+
+        def do_POST(self):
+            if self.path != '/powerControl':
+                self.reply(404, {'error': 'GET /info or POST /powerControl'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                request = parsePowerControlRequest(body, models, systemParameters)
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                self.reply(400, {'error': str(error)})
+                return
+
+            microBatcher.submit(request)
+            if request.error is not None:
+                self.reply(500, {'error': request.error})
+                return
+            self.reply(200, {'mus': request.mus.tolist(), 'se': request.se.tolist()})
+
+        def log_message(self, format, *args):
+            pass  # no log line per request
+
+    return PowerControlRequestHandler
+
+
+def makeSocketRequestHandler(microBatcher, models, systemParameters):
+
+    class PowerControlSocketHandler(socketserver.StreamRequestHandler):
+        # Answers the requests of a connection one after the other until the client closes it
+        disable_nagle_algorithm = True
+
+        def reply(self, status, payload):
+            self.wfile.write(MESSAGE_LENGTH.pack(1 + len(payload)) + bytes([status]) + payload)
+
+        def handle(self):
+            while True:
+                prefix = self.rfile.read(MESSAGE_LENGTH.size)
+                if len(prefix) < MESSAGE_LENGTH.size:
+                    return
+                (length, ) = MESSAGE_LENGTH.unpack(prefix)
+                message = self.rfile.read(length)
+                if len(message) < length:
+                    return
+
+                try:
+                    request = parseSocketRequest(message, models, systemParameters)
+                except ValueError as error:
+                    self.reply(SOCKET_BAD_REQUEST, str(error).encode())
+                    continue
+
+                microBatcher.submit(request)
+                if request.error is not None:
+                    self.reply(SOCKET_SERVER_ERROR, request.error.encode())
+                    continue
+                output = torch.cat([request.mus.reshape(-1), request.se.reshape(-1)])
+                self.reply(SOCKET_OK, output.numpy().astype('<f4').tobytes())
+
+    return PowerControlSocketHandler
+
+
+class PowerControlSocketClient:
+    # Client of the binary socket protocol, over one connection kept open between requests
+
+    def __init__(self, port, host=SERVE_HOST):
+        self.connection = socket.create_connection((host, port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('The server closed the connection.')
+            data += chunk
+        return bytes(data)
+
+    def powerControl(self, betas, pilotSequence, modelIndex=0):
+        # betas M X K (linear scale) and pilotSequence K. Returns the mus M X K and the SEs K.
+        # Raises ValueError if the server rejects the request and RuntimeError if it fails.
+        betas = np.ascontiguousarray(betas, dtype='<f4')
+        numberOfUsers = betas.shape[1]
+        message = SOCKET_REQUEST_HEADER.pack(modelIndex, numberOfUsers) + betas.tobytes() \
+            + np.asarray(pilotSequence, dtype=np.uint8).tobytes()
+        self.connection.sendall(MESSAGE_LENGTH.pack(len(message)) + message)
+
+        (length, ) = MESSAGE_LENGTH.unpack(self.receive(MESSAGE_LENGTH.size))
+        reply = self.receive(length)
+        if reply[0] == SOCKET_BAD_REQUEST:
+            raise ValueError(reply[1:].decode())
+        if reply[0] != SOCKET_OK:
+            raise RuntimeError(reply[1:].decode())
+        output = torch.from_numpy(np.frombuffer(reply, dtype='<f4', offset=1).copy())
+        numberOfMus = betas.size
+        return output[:numberOfMus].view(betas.shape), output[numberOfMus:]
+
+    def close(self):
+        self.connection.close()
+
+
+def serve(simulationParameters, systemParameters):
+    device = torch.device('cpu')  # The requests are small, so they are served on the CPU.
+    models = setupAndLoadDeepLearningModels(
+                                                systemParameters.models,
+                                                simulationParameters,
+                                                systemParameters,
+                                                device
+                                            )
+    microBatcher = MicroBatcher(models, systemParameters, simulationParameters.maxWait*1e-6)
+    server = ThreadingHTTPServer(
+                                    (SERVE_HOST, simulationParameters.port),
+                                    makeRequestHandler(microBatcher, models, systemParameters)
+                                )
+    server.daemon_threads = True
+    print(f'Serving the power coefficients of {list(models)} on '
+          f'http://{SERVE_HOST}:{simulationParameters.port}/powerControl.')
+
+    socketServer = None
+    if simulationParameters.socketPort > 0:
+        socketServer = socketserver.ThreadingTCPServer(
+                                    (SERVE_HOST, simulationParameters.socketPort),
+                                    makeSocketRequestHandler(microBatcher, models, systemParameters)
+                                )
+        socketServer.daemon_threads = True
+        threading.Thread(target=socketServer.serve_forever, daemon=True).start()
+        print(f'Serving the binary socket protocol on '
+              f'{SERVE_HOST}:{simulationParameters.socketPort}.')
+    print('Press Ctrl+C to stop.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketServer is not None:
+            socketServer.shutdown()
+            socketServer.server_close()
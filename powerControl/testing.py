@@ -1,13 +1,31 @@
 import os
+import math
 import torch
+import torch.nn.functional as F
 import time
 from tqdm import tqdm
-
-from .utils import compute_v_mat, utilityComputation
-from .gradientHandler import grads, grad_f
-from .models.utils import loadTheLatestModelAndParamsIfExists, deploy, initializeHyperParams
+from torch.utils.data import DataLoader
+
+from .gradientHandler import grads
+from .channelContext import ChannelContext
+from .utils import PILOT_PAD
+from .models.utils import (
+    loadTheLatestModelAndParamsIfExists,
+    initializeHyperParams,
+    quantizeModel,
+    modelSize,
+    checkpointHash,
+)
+from .models.rootModel import RootDataset, PAD_CONST
 from utils.visualization import performancePlotter, consolidatedPlotter, localPlotEditor
+from utils.sampleStore import openSampleReader, loadManifest
+from utils.resultsStore import ResultsWriter, RESULTS_FILE
+from utils.baselineCache import baselineCacheKey, restoreFromCache, saveToCache
+
 
+LOG_CONVERSION_CONST = math.log2(math.e)  # nat/sec/Hz to bits/sec/Hz
+LATENCY_NUMBER_OF_SAMPLES = 100  # samples timed one by one when testing in batches
+RESULTS_FLUSH_INTERVAL = 100  # samples tested between the flushes of the results to disk
 
 
 def project2s(y, const):
@@ -21,36 +39,66 @@ def project2s(y, const):
 
 
 def epa(vMat, device):
-    vMat = torch.squeeze(vMat, dim=0)
-    etaa = 1 / vMat.sum(dim=1)
-    etaaOuter = torch.outer(
-                                etaa,
-                                torch.ones(
-                                                (vMat.shape[1],),
-                                                device=device,
-                                                requires_grad=False,
-                                                dtype=torch.float32
-                                        )
-                            )
-    mus = torch.sqrt(etaaOuter * vMat)
-    mus = torch.unsqueeze(mus, dim=0)
+    # vMat b X M X K, with the v of the padded users set to 0
+    etaa = 1 / vMat.sum(dim=2, keepdim=True)
+    mus = torch.sqrt(etaa * vMat)
     return mus
 
 
-def apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
-    import math
+def apgInit(betas, device, musVec=None):
+    # initialization of the APG iterates mu and y, random unless musVec is given (warm start)
+    if musVec is None:
+        torch.seed()
+        musVec = torch.rand(betas.shape, requires_grad=False, device=device, dtype=torch.float32)
     torch.seed()
+    y = musVec\
+            + 0.01*torch.rand(betas.shape, requires_grad=False, device=device, dtype=torch.float32)
+    return musVec, y
+
+
+# APG stops once the relative change of the utility or of mu stays below the tolerance for this
+# many iterations in a row.
+APG_PATIENCE = 3
+
+
+APG_TOLERANCE = 1e-3  # tolerance of APG with --apgTolerance
+REFINED_SUFFIX = '+APG'  # algoName of a deep learning model refined by APG, e.g. 'TNN+APG'
+QUANTIZED_SUFFIX = '-INT8'  # algoName of an int8 quantized deep learning model, e.g. 'TNN-INT8'
+# Versions of the algos whose results are cached across the test runs on the same test data. Bump
+# the version of an algo whenever its results change, so that stale cached results are not used.
+BASELINE_ALGO_VERSIONS = {'EPA': 1, 'APG': 1, }
+
+
+def apgStalled(uOld, uNew, musVecOld, musVecNew, tolerance):
+    # Relative change of the utility or of the iterate, per sample, below tolerance
+    utilityChange = torch.abs(uNew - uOld) / torch.abs(uOld)
+    iterateChange = torch.linalg.vector_norm(musVecNew - musVecOld, dim=(1, 2))\
+        / torch.linalg.vector_norm(musVecOld, dim=(1, 2))
+    return (utilityChange <= tolerance) | (iterateChange <= tolerance)
+
+
+def apgAlgo(channelContext, device, init=None, tolerance=None, iterations=30):
+    # channelContext of a single sample (see channelContext.ChannelContext)
+    # init: (mu, y) to start from, apgInit by default
+    # tolerance: stops once the utility or mu change by less than tolerance (relative) for
+    # APG_PATIENCE iterations in a row. Without it, all the iterations are run.
+    # The gradients and utilities that do not change within an iteration, or that are carried over
+    # from the previous one, are evaluated only once.
+    # Returns mu, the utility and the number of iterations run
+    import math
+    betas = channelContext.betas
+    N = channelContext.N
+    gradient = lambda mus: channelContext.grad(mus)[0]
+    utility = lambda mus: channelContext.utility(mus)[0]
     
-    # random initialization
-    musVecOld = torch.rand(betas.shape, requires_grad=False, device=device, dtype=torch.float32)
+    if init is None:
+        init = apgInit(betas, device)
+    [musVecOld, y] = init
 
     tOld = 0
     tNew = 1
     musVecNew = musVecOld
     z = musVecNew
-    torch.seed()
-    y = musVecNew\
-            + 0.01*torch.rand(betas.shape, requires_grad=False, device=device, dtype=torch.float32)
     v = y * 0
     rho = 0.8
     delta = 1e-5
@@ -58,17 +106,24 @@ def apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
     const =  1 / math.sqrt(N)
     epsilon = 1e-10
 
-    for _ in range(30):
+    grad_y = gradient(y)
+    grad_muOld = gradient(musVecOld)
+    u_mu = utility(musVecNew)
+    stalls = 0
+    iteration = 0
+    while iteration < iterations:
+        iteration += 1
+
+        grad_z = gradient(z)
+        grad_v = gradient(v)
 
         s = z - y
-        r = grad_f(betas, z, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)[0]\
-                - grad_f(betas, y, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)[0]
+        r = grad_z - grad_y
         denTemp = torch.dot(s.flatten(), r.flatten()) + epsilon
         alpha_y = torch.dot(s.flatten(), s.flatten()) / denTemp
 
         s = v - musVecOld
-        r = grad_f(betas, v, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)[0]\
-                - grad_f(betas, musVecOld, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)[0]
+        r = grad_v - grad_muOld
         denTemp = torch.dot(s.flatten(), r.flatten()) + epsilon
         alpha_mu = torch.dot(s.flatten(), s.flatten()) / denTemp
 
@@ -78,25 +133,18 @@ def apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
                 + (tOld / tNew) * (z - musVecNew)\
                 + ((tOld - 1) / tNew) * (musVecNew - musVecOld)
 
+        # musVecNew is the z or the v of the previous iteration
+        if iteration == 1:
+            grad_mu = grad_muOld
+        else:
+            grad_mu = grad_z if u_z > u_v else grad_v
+        grad_y = gradient(y)
+        u_y = utility(y)
+
         while 1:
-            z = project2s(
-                                y + alpha_y * grad_f(
-                                                        betas,
-                                                        y,
-                                                        N,
-                                                        zeta_d,
-                                                        Tp,
-                                                        Tc,
-                                                        phiCrossMat,
-                                                        vMat,
-                                                        tau,
-                                                        device
-                                                    )[0],
-                                const
-                        )
+            z = project2s(y + alpha_y * grad_y, const)
             alpha_y = rho * alpha_y
-            u_z, _ = utilityComputation(betas, z, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)
-            u_y, _ = utilityComputation(betas, y, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)
+            u_z = utility(z)
             deltaDiff = delta * torch.dot((z - y).flatten(), (z - y).flatten())
             
             if alpha_y < epsilon:
@@ -112,35 +160,9 @@ def apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
                 break
 
         while 1:
-            v = project2s(
-                                musVecNew + alpha_mu * grad_f(
-                                                                    betas,
-                                                                    musVecNew,
-                                                                    N,
-                                                                    zeta_d,
-                                                                    Tp,
-                                                                    Tc,
-                                                                    phiCrossMat,
-                                                                    vMat,
-                                                                    tau,
-                                                                    device
-                                                                )[0],
-                                const
-                        )
+            v = project2s(musVecNew + alpha_mu * grad_mu, const)
             alpha_mu = rho * alpha_mu
-            u_v, _ = utilityComputation(betas, v, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)
-            u_mu, _ = utilityComputation(
-                                            betas,
-                                            musVecNew,
-                                            N,
-                                            zeta_d,
-                                            Tp,
-                                            Tc,
-                                            phiCrossMat,
-                                            vMat,
-                                            tau,
-                                            device
-                                        )
+            u_v = utility(v)
             deltaDiff = delta * torch.dot((v - musVecNew).flatten(), (v - musVecNew).flatten())
             
             if alpha_mu < epsilon:
@@ -155,72 +177,292 @@ def apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
             if u_v >= (u_mu + deltaDiff):
                 break
         musVecOld = musVecNew
+        grad_muOld = grad_mu
         musVecNew = z if u_z > u_v else v
+        uOld = u_mu
+        u_mu = max(u_z, u_v)
 
         tOld = tNew
         tNew = 0.5 * (math.sqrt(4 * tNew ** 2 + 1) + 1)
+
+        if tolerance is not None:
+            stalls = stalls + 1 if apgStalled(uOld, u_mu, musVecOld, musVecNew, tolerance) else 0
+            if stalls == APG_PATIENCE:
+                break
     
 
-    return musVecNew, max(u_z, u_v)
+    return musVecNew, max(u_z, u_v), iteration
 
 
-def runPowerControlAlgos(simulationParameters, systemParameters, algoList, models, sampleId):
-    device = torch.device('cpu')
+def apgAlgoBatch(channelContext, device, init=None, tolerance=None, iterations=30):
+    # apgAlgo on the b samples of channelContext at once. Every sample has its own step sizes, its
+    # own line searches and its own stopping, so the result of each sample is the one of apgAlgo
+    # from the same init. Converged samples are dropped from the batch.
+    # Use a channelContext with maskPaddedUsers for batches of padded samples.
+    # init: (mu, y) b X M X K to start from, apgInit by default
+    # Returns mu b X M X K, the utilities b and the numbers of iterations run b
+    import math
+    import sys
+    betas = channelContext.betas
+    N = channelContext.N
+    gradient = lambda mus: channelContext.grad(mus)[0]
+    utility = lambda mus: channelContext.utility(mus)[0]
+    batchDot = lambda a, b: torch.einsum('bmk, bmk -> b', a, b)
+    expand = lambda x: x.view(-1, 1, 1)
+
+    if init is None:
+        init = apgInit(betas, device)
+    musVecOld = channelContext.maskMus(init[0])
+    y = channelContext.maskMus(init[1])
 
-    filePathAndName = os.path.join(simulationParameters.dataFolder, f'betasSample{sampleId}.pt')
-    m = torch.load(filePathAndName)
+    tOld = 0
+    tNew = 1
+    musVecNew = musVecOld
+    z = musVecNew
+    v = y * 0
+    rho = 0.8
+    delta = 1e-5
 
-    betas = m['betas'].to(dtype=torch.float32, device=device)
-    betas = torch.unsqueeze(betas, 0)
+    const =  1 / math.sqrt(N)
+    epsilon = 1e-10
 
-    pilotSequence = m['pilotSequence']
+    # results of the samples, filled in as they converge
+    B = betas.shape[0]
+    musOut = torch.zeros_like(musVecNew)
+    utilityOut = torch.zeros((B,), device=device, dtype=musVecNew.dtype)
+    iterationsOut = torch.full((B,), iterations, device=device, dtype=torch.int64)
+    sampleIndex = torch.arange(B, device=device)  # samples still running
+    stalls = torch.zeros((B,), device=device, dtype=torch.int64)
+
+    grad_y = gradient(y)
+    grad_muOld = gradient(musVecOld)
+    u_mu = utility(musVecNew)
+    u_z = u_mu
+    u_v = u_mu
+    for iteration in range(1, iterations + 1):
+        grad_z = gradient(z)
+        grad_v = gradient(v)
+
+        # Barzilai-Borwein step sizes
+        s = z - y
+        r = grad_z - grad_y
+        alpha_y = torch.abs(batchDot(s, s) / (batchDot(s, r) + epsilon))
 
-    N = systemParameters.numberOfAntennas
-    zeta_d = systemParameters.zeta_d
-    zeta_p = systemParameters.zeta_p
-    Tp = systemParameters.Tp
-    Tc = systemParameters.Tc
+        s = v - musVecOld
+        r = grad_v - grad_muOld
+        alpha_mu = torch.abs(batchDot(s, s) / (batchDot(s, r) + epsilon))
 
-    phi = torch.index_select(systemParameters.phiOrth, 0, pilotSequence)
-    phiCrossMat = torch.abs(phi.conj() @ phi.T).to(dtype=torch.float32, device=device)
-    phiCrossMat = torch.unsqueeze(phiCrossMat**2, dim=0)
-    tau = systemParameters.tau
+        y = musVecNew\
+                + (tOld / tNew) * (z - musVecNew)\
+                + ((tOld - 1) / tNew) * (musVecNew - musVecOld)
+
+        # musVecNew is the z or the v of the previous iteration
+        if iteration == 1:
+            grad_mu = grad_muOld
+        else:
+            grad_mu = torch.where(expand(u_z > u_v), grad_z, grad_v)
+        grad_y = gradient(y)
+        u_y = utility(y)
+
+        # Backtracking line searches, on the samples that have not accepted a step yet
+        searching = torch.arange(len(sampleIndex), device=device)
+        while len(searching) > 0:
+            y_s = y[searching]
+            zNew = project2s(y_s + expand(alpha_y[searching]) * grad_y[searching], const)
+            alphaNew = rho * alpha_y[searching]
+            u_zNew = channelContext.select(searching).utility(zNew)[0]
+            deltaDiff = delta * batchDot(zNew - y_s, zNew - y_s)
+            z = z.index_copy(0, searching, zNew)
+            alpha_y = alpha_y.index_copy(0, searching, alphaNew)
+            u_z = u_z.index_copy(0, searching, u_zNew)
+
+            searchMask = alphaNew >= epsilon
+            if not torch.isfinite(u_zNew + u_y[searching] + alphaNew)[searchMask].all():
+                print('APG error in loop1')
+                print(u_zNew, u_y[searching], alphaNew)
+                sys.exit()
+            searchMask = searchMask & (u_zNew < (u_y[searching] + deltaDiff))
+            searching = searching[searchMask]
+
+        searching = torch.arange(len(sampleIndex), device=device)
+        while len(searching) > 0:
+            mu_s = musVecNew[searching]
+            vNew = project2s(mu_s + expand(alpha_mu[searching]) * grad_mu[searching], const)
+            alphaNew = rho * alpha_mu[searching]
+            u_vNew = channelContext.select(searching).utility(vNew)[0]
+            deltaDiff = delta * batchDot(vNew - mu_s, vNew - mu_s)
+            v = v.index_copy(0, searching, vNew)
+            alpha_mu = alpha_mu.index_copy(0, searching, alphaNew)
+            u_v = u_v.index_copy(0, searching, u_vNew)
+
+            searchMask = alphaNew >= epsilon
+            if not torch.isfinite(u_vNew + u_mu[searching] + alphaNew)[searchMask].all():
+                print('APG error in loop2')
+                print(u_vNew, u_mu[searching], alphaNew)
+                sys.exit()
+            searchMask = searchMask & (u_vNew < (u_mu[searching] + deltaDiff))
+            searching = searching[searchMask]
 
-    vMat = compute_v_mat(betas, zeta_p, Tp, phiCrossMat)
+        musVecOld = musVecNew
+        grad_muOld = grad_mu
+        musVecNew = torch.where(expand(u_z > u_v), z, v)
+        uOld = u_mu
+        u_mu = torch.maximum(u_z, u_v)
+
+        tOld = tNew
+        tNew = 0.5 * (math.sqrt(4 * tNew ** 2 + 1) + 1)
+
+        if tolerance is None or iteration == iterations:
+            continue
+        stalled = apgStalled(uOld, u_mu, musVecOld, musVecNew, tolerance)
+        stalls = torch.where(stalled, stalls + 1, 0)
+        converged = stalls == APG_PATIENCE
+        if converged.any():
+            done = sampleIndex[converged]
+            musOut[done] = musVecNew[converged]
+            utilityOut[done] = u_mu[converged]
+            iterationsOut[done] = iteration
+
+            running = ~converged
+            if not running.any():
+                return musOut, utilityOut, iterationsOut
+            sampleIndex = sampleIndex[running]
+            channelContext = channelContext.select(running)
+            state = (musVecOld, musVecNew, z, v, y, grad_y, grad_muOld, u_z, u_v, u_mu, stalls)
+            (musVecOld, musVecNew, z, v, y, grad_y, grad_muOld, u_z, u_v, u_mu, stalls) = (
+                x[running] for x in state
+            )
+
+    musOut[sampleIndex] = musVecNew
+    utilityOut[sampleIndex] = u_mu
+    return musOut, utilityOut, iterationsOut
+
+
+def runPowerControlAlgos(
+                            systemParameters,
+                            algoList,
+                            models,
+                            sampleReader,
+                            sampleId,
+                            apgTolerance,
+                            refineIterations
+                        ):
+    device = torch.device('cpu')
+
+    betas, pilotSequence = sampleReader.getSample(sampleId)
+    betas = betas.to(dtype=torch.float32, device=device)
+    betas = torch.unsqueeze(betas, 0)
+    pilotSequences = torch.unsqueeze(pilotSequence.to(device=device), 0)  # 1 X K
+
+    # mu-independent terms shared by all the algorithms and the SE evaluation
+    channelContext = ChannelContext(betas, pilotSequences, systemParameters)
+
+    # The inputs of the deep learning models, padded to the maximum number of users as in deploy.
+    # Like channelContext, they are prepared before the timing, as RootDataset prepares those of
+    # runPowerControlAlgosBatch.
+    numberOfUsers = pilotSequences.shape[-1]
+    padUsers = systemParameters.maxNumberOfUsers - numberOfUsers
+    pilotSequencesPadded = pilotSequences.to(dtype=torch.uint8)
+    modelInputs = [
+                    torch.log(F.pad(betas, (0, padUsers), 'constant', PAD_CONST)),
+                    F.pad(pilotSequencesPadded, (0, padUsers), 'constant', PILOT_PAD)
+                ]
 
     latencyDict = {}
     seDict = {}
+    apgIterations = 0
     for algoName in algoList:
         
         timeThen = time.perf_counter()
         if algoName == 'EPA':
-            mus = epa(vMat, device)
+            mus = epa(channelContext.vMat, device)
         elif algoName == 'APG':
-            mus, _ = apgAlgo(betas, N, zeta_d, Tp, Tc, phiCrossMat, vMat, tau, device)
+            mus, _, apgIterations = apgAlgo(channelContext, device, tolerance=apgTolerance)
+        elif algoName.endswith(REFINED_SUFFIX):
+            # APG warm-started from the output of the deep learning model
+            modelName = algoName[:-len(REFINED_SUFFIX)]
+            with torch.no_grad():
+                mus = models[modelName](modelInputs)[:, :, :numberOfUsers]
+            mus, _, _ = apgAlgo(
+                                    channelContext,
+                                    device,
+                                    init=apgInit(betas, device, mus),
+                                    tolerance=apgTolerance,
+                                    iterations=refineIterations
+                                )
         else:
             modelName = algoName  # this algo is deep learning algo
-            mus = deploy(models[modelName], betas, phiCrossMat, modelName, device)
+            with torch.no_grad():
+                mus = models[modelName](modelInputs)[:, :, :numberOfUsers]
         
         timeNow = time.perf_counter()
-        latencyDict[algoName] = round(timeNow - timeThen, 6)
+        latencyDict[algoName] = timeNow - timeThen
         
-        _, seDict[algoName] = utilityComputation(
-                                                betas,
-                                                mus,
-                                                N,
-                                                zeta_d,
-                                                Tp,
-                                                Tc,
-                                                phiCrossMat,
-                                                vMat,
-                                                tau,
-                                                device
-                                            )
-    return seDict, latencyDict
-
-
-def saveLatency(resultPath, latency):
-    m = {'latency': latency, }
+        _, se = channelContext.utility(mus)
+        seDict[algoName] = se[0]
+    return seDict, latencyDict, apgIterations
+
+
+def runPowerControlAlgosBatch(
+                                systemParameters,
+                                algoList,
+                                models,
+                                batch,
+                                apgTolerance,
+                                refineIterations,
+                                device
+                            ):
+    # runPowerControlAlgos on a batch of padded samples from RootDataset
+    # Returns the SEs b X K of every algo (0 for the padded users), the time every algo took on the
+    # whole batch and the numbers of APG iterations b
+    pilotSequences, logBetas, _ = batch
+    pilotSequences = pilotSequences.to(device=device)
+    logBetas = logBetas.to(device=device)
+    betas = torch.exp(logBetas)
+
+    # mu-independent terms shared by all the algorithms and the SE evaluation
+    channelContext = ChannelContext(betas, pilotSequences, systemParameters, maskPaddedUsers=True)
+
+    timeDict = {}
+    seDict = {}
+    apgIterations = torch.zeros((betas.shape[0],), dtype=torch.int64)
+    for algoName in algoList:
+
+        timeThen = time.perf_counter()
+        if algoName == 'EPA':
+            mus = epa(channelContext.maskMus(channelContext.vMat), device)
+        elif algoName == 'APG':
+            mus, _, apgIterations = apgAlgoBatch(channelContext, device, tolerance=apgTolerance)
+        elif algoName.endswith(REFINED_SUFFIX):
+            # APG warm-started from the output of the deep learning model
+            mus = models[algoName[:-len(REFINED_SUFFIX)]]([logBetas, pilotSequences])
+            mus, _, _ = apgAlgoBatch(
+                                        channelContext,
+                                        device,
+                                        init=apgInit(betas, device, channelContext.maskMus(mus)),
+                                        tolerance=apgTolerance,
+                                        iterations=refineIterations
+                                    )
+        elif algoName.endswith(QUANTIZED_SUFFIX):
+            # Dynamic quantization scales the activations by their range over the whole input,
+            # padded users included, so the quantized models run sample by sample to give the
+            # same SEs for every test batch size.
+            mus = torch.cat([
+                                models[algoName]([logBetas[b:b + 1], pilotSequences[b:b + 1]])
+                                for b in range(logBetas.shape[0])
+                            ])
+        else:
+            mus = models[algoName]([logBetas, pilotSequences])
+
+        timeNow = time.perf_counter()
+        timeDict[algoName] = timeNow - timeThen
+
+        seDict[algoName] = channelContext.se(mus)
+    return seDict, timeDict, apgIterations
+
+
+def saveLatency(resultPath, latency, apgIterations=None):
+    m = {'latency': latency, 'apgIterations': apgIterations, }
     torch.save(m, os.path.join(resultPath, f'latency.pt'))
 
 
@@ -228,7 +470,14 @@ def loadLatency(resultPath):
     return torch.load(os.path.join(resultPath, f'latency.pt'))['latency']
 
 
-def setupAndLoadDeepLearningModels(modelsToRun, simulationParameters, systemParameters):
+def setupAndLoadDeepLearningModels(
+                                        modelsToRun,
+                                        simulationParameters,
+                                        systemParameters,
+                                        device,
+                                        quantize=False
+                                    ):
+    # With quantize, the int8 copy of every model is added as f'{modelName}{QUANTIZED_SUFFIX}'.
     modelFolderDict = simulationParameters.modelSubfolderPathDict
     
     
@@ -242,53 +491,285 @@ def setupAndLoadDeepLearningModels(modelsToRun, simulationParameters, systemPara
                                                                     grads,
                                                                     isTesting=True
                                                                 )
+        models[modelName].eval()
+        models[modelName].to(device=device)
+
+    if quantize:
+        # The quantized kernels only run on the CPU.
+        for modelName in modelsToRun:
+            quantizedModelName = f'{modelName}{QUANTIZED_SUFFIX}'
+            models[quantizedModelName] = quantizeModel(models[modelName].to(device='cpu'))
+            print(f'{quantizedModelName}: {modelSize(models[quantizedModelName])} bytes, '
+                  f'{modelName}: {modelSize(models[modelName])} bytes')
     
     return models
 
 
-def testAndPlot(simulationParameters, systemParameters, plottingOnly):
-    device = torch.device('cpu')  # Need to force this. We do not want to test in GPU.
+def testPerSample(
+                    systemParameters,
+                    algoList,
+                    models,
+                    sampleReader,
+                    numberOfSamples,
+                    apgTolerance,
+                    refineIterations,
+                    resultsWriter,
+                    saveSe=True
+                ):
+    # Runs the algos sample by sample, timing each one, and writes the latencies and, with saveSe,
+    # the SEs to resultsWriter. The algos whose SE (or, without saveSe, latency) is already in
+    # resultsWriter are skipped.
+    for sampleId in tqdm(range(numberOfSamples)):
+        pendingAlgoList = resultsWriter.pendingAlgos(algoList, sampleId, latency=not saveSe)
+        if not pendingAlgoList:
+            continue
+
+        seDict, latencyDict, apgIterations = runPowerControlAlgos(
+                                                                    systemParameters,
+                                                                    pendingAlgoList,
+                                                                    models,
+                                                                    sampleReader,
+                                                                    sampleId,
+                                                                    apgTolerance,
+                                                                    refineIterations
+                                                                )
+        for algoName in pendingAlgoList:
+            se = seDict[algoName].unsqueeze(0)
+            resultsWriter.write(
+                                    algoName,
+                                    sampleId,
+                                    se=se*LOG_CONVERSION_CONST if saveSe else None,
+                                    numberOfUsers=[se.shape[1]],
+                                    latency=[latencyDict[algoName]],
+                                    apgIterations=[apgIterations] if algoName == 'APG' else None
+                                )
+        if (sampleId + 1) % RESULTS_FLUSH_INTERVAL == 0:
+            resultsWriter.flush()
+    resultsWriter.flush()
+
+
+def testInBatches(
+                    simulationParameters,
+                    systemParameters,
+                    algoList,
+                    models,
+                    apgTolerance,
+                    refineIterations,
+                    resultsWriter,
+                    device
+                ):
+    # Runs the algos on whole batches of testBatchSize samples and writes their SEs to
+    # resultsWriter. The algos whose SEs are already in resultsWriter for the whole batch are
+    # skipped.
+    # Returns the time every algo took per sample, averaged over the batches it ran on, for the
+    # algos that ran on at least one batch.
+    numberOfSamples = simulationParameters.numberOfSamples
+    dataset = RootDataset(
+                            simulationParameters.dataFolder,
+                            numberOfSamples,
+                            systemParameters.maxNumberOfUsers,
+                            PAD_CONST
+                        )
+    dataLoader = DataLoader(dataset, batch_size=simulationParameters.testBatchSize, shuffle=False)
+
+    batchLatency = {}
+    numberOfTestedSamples = {}
+    for algoName in algoList:
+        batchLatency[algoName] = 0
+        numberOfTestedSamples[algoName] = 0
+
+    sampleId = 0
+    with torch.no_grad():
+        for batch in tqdm(dataLoader):
+            numberOfUsers = batch[2]
+            pendingAlgoList = resultsWriter.pendingAlgos(
+                                                            algoList,
+                                                            sampleId,
+                                                            sampleId + len(numberOfUsers)
+                                                        )
+            if pendingAlgoList:
+                seDict, timeDict, apgIterations = runPowerControlAlgosBatch(
+                                                                            systemParameters,
+                                                                            pendingAlgoList,
+                                                                            models,
+                                                                            batch,
+                                                                            apgTolerance,
+                                                                            refineIterations,
+                                                                            device
+                                                                        )
+                for algoName in pendingAlgoList:
+                    batchLatency[algoName] += timeDict[algoName]
+                    numberOfTestedSamples[algoName] += len(numberOfUsers)
+                    resultsWriter.write(
+                                            algoName,
+                                            sampleId,
+                                            se=seDict[algoName]*LOG_CONVERSION_CONST,
+                                            numberOfUsers=numberOfUsers,
+                                            apgIterations=apgIterations if algoName=='APG' else None
+                                        )
+                resultsWriter.flush()
+            sampleId += len(numberOfUsers)
+
+    for algoName in algoList:
+        if numberOfTestedSamples[algoName] == 0:
+            del batchLatency[algoName]
+        else:
+            batchLatency[algoName] /= numberOfTestedSamples[algoName]
+    return batchLatency
+
+
+def getAlgoList(simulationParameters, systemParameters):
     algoList = ['EPA', 'APG', ]
     modelsList = systemParameters.models  # deep learning models
 
     algoList += modelsList
+    if simulationParameters.refineIterations > 0:
+        algoList += [f'{modelName}{REFINED_SUFFIX}' for modelName in modelsList]
+    if simulationParameters.quantizeFlag:
+        algoList += [f'{modelName}{QUANTIZED_SUFFIX}' for modelName in modelsList]
+    return algoList, modelsList
+
+
+def testAndPlot(simulationParameters, systemParameters, plottingOnly):
+    device = torch.device('cpu')  # Need to force this. We do not want to test in GPU.
+    algoList, modelsList = getAlgoList(simulationParameters, systemParameters)
     
     resultsPath = simulationParameters.resultsFolder
     if plottingOnly:
         avgLatency = loadLatency(resultsPath)
     else:
-        LOG_CONVERSION_CONST = torch.log2(torch.exp(torch.scalar_tensor(1))).to(device=device)
-        models = setupAndLoadDeepLearningModels(modelsList, simulationParameters, systemParameters)
+        models = setupAndLoadDeepLearningModels(
+                                                    modelsList,
+                                                    simulationParameters,
+                                                    systemParameters,
+                                                    device,
+                                                    simulationParameters.quantizeFlag
+                                                )
         numberOfSamples = simulationParameters.numberOfSamples
-
-        avgLatency = {}
+        sampleReader = openSampleReader(simulationParameters.dataFolder)
+        apgTolerance = APG_TOLERANCE if simulationParameters.apgToleranceFlag else None
+        refineIterations = simulationParameters.refineIterations
+        # The results of an interrupted run on the same data are resumed, except those of the
+        # algos whose APG settings or trained models changed, e.g. after a retraining.
+        dataManifest = loadManifest(simulationParameters.dataFolder)
+        resultsConfig = {'data': None if dataManifest is None else dataManifest['config'], }
+        checkpoints = {
+                            modelName: checkpointHash(models[modelName].checkpointPath)
+                            for modelName in modelsList
+                        }
+        algoConfigs = {}
         for algoName in algoList:
-            avgLatency[algoName] = 0
-        
-        for sampleId in tqdm(range(numberOfSamples)):
-            
-            seDict, latencyDict = runPowerControlAlgos(
-                                                            simulationParameters,
-                                                            systemParameters,
-                                                            algoList,
-                                                            models,
-                                                            sampleId
-                                                    )
+            if algoName == 'APG':
+                algoConfigs[algoName] = {'apgTolerance': apgTolerance, }
+            elif algoName.endswith(REFINED_SUFFIX):
+                modelName = algoName[:-len(REFINED_SUFFIX)]
+                algoConfigs[algoName] = {
+                                            'checkpoint': checkpoints[modelName],
+                                            'apgTolerance': apgTolerance,
+                                            'refineIterations': refineIterations,
+                                        }
+            elif algoName.endswith(QUANTIZED_SUFFIX):
+                modelName = algoName[:-len(QUANTIZED_SUFFIX)]
+                algoConfigs[algoName] = {'checkpoint': checkpoints[modelName], }
+            elif algoName in checkpoints:
+                algoConfigs[algoName] = {'checkpoint': checkpoints[algoName], }
+        resultsWriter = ResultsWriter(
+                                        resultsPath,
+                                        algoList,
+                                        numberOfSamples,
+                                        systemParameters.maxNumberOfUsers,
+                                        config=resultsConfig,
+                                        algoConfigs=algoConfigs
+                                    )
+
+        # EPA and APG do not depend on the models, so their results are shared with the other test
+        # runs on the same test data through a cache under rootPath.
+        baselineKeys = []
+        if dataManifest is not None:
             for algoName in algoList:
-                resultSample = seDict[algoName]*LOG_CONVERSION_CONST  # nat/sec/Hz to bits/sec/Hz
-                avgLatency[algoName] += (1/numberOfSamples)*latencyDict[algoName]
-
-                resultSampleDict = {'resultSample': resultSample, }
-                filePath = os.path.join(resultsPath, f'{algoName}ResultsSample{sampleId}.pt')
-                torch.save(resultSampleDict, filePath)
+                if algoName in BASELINE_ALGO_VERSIONS:
+                    baselineKeys.append(baselineCacheKey(
+                                                            algoName,
+                                                            BASELINE_ALGO_VERSIONS[algoName],
+                                                            dataManifest['config'],
+                                                            systemParameters.getConstants(),
+                                                            algoConfigs.get(algoName)
+                                                        ))
+        for baselineKey in baselineKeys:
+            numberOfRestoredSamples = restoreFromCache(
+                                                            simulationParameters.rootPath,
+                                                            baselineKey,
+                                                            resultsWriter
+                                                        )
+            if numberOfRestoredSamples > 0:
+                print(f'Reusing the cached {baselineKey["algo"]} results of '
+                      f'{numberOfRestoredSamples} samples.')
+
+        if simulationParameters.testBatchSize > 0:
+            batchLatency = testInBatches(
+                                            simulationParameters,
+                                            systemParameters,
+                                            algoList,
+                                            models,
+                                            apgTolerance,
+                                            refineIterations,
+                                            resultsWriter,
+                                            device
+                                        )
+            if batchLatency:
+                print(f'Time per sample in batches of {simulationParameters.testBatchSize}:')
+                print(batchLatency)
+            reusedAlgoList = [algoName for algoName in algoList if algoName not in batchLatency]
+            if reusedAlgoList:
+                print(f'Reused the SEs of {reusedAlgoList} from {RESULTS_FILE}.')
+        else:
+            testPerSample(
+                            systemParameters,
+                            algoList,
+                            models,
+                            sampleReader,
+                            numberOfSamples,
+                            apgTolerance,
+                            refineIterations,
+                            resultsWriter
+                        )
 
-        saveLatency(resultsPath, avgLatency)
+        # The per-sample latency is measured separately, sample by sample, on the first few
+        # samples whose SEs were computed in batches or restored from the baseline cache.
+        testPerSample(
+                        systemParameters,
+                        algoList,
+                        models,
+                        sampleReader,
+                        min(LATENCY_NUMBER_OF_SAMPLES, numberOfSamples),
+                        apgTolerance,
+                        refineIterations,
+                        resultsWriter,
+                        saveSe=False
+                    )
+
+        for baselineKey in baselineKeys:
+            saveToCache(simulationParameters.rootPath, baselineKey, resultsWriter)
+
+        # Averaged over all the samples in resultsWriter, including those of the resumed runs
+        avgLatency = {}
+        for algoName in algoList:
+            avgLatency[algoName] = resultsWriter.averageLatency(algoName)
+        avgApgIterations = resultsWriter.averageApgIterations()
+        saveLatency(resultsPath, avgLatency, avgApgIterations)
+        print(f'Average number of APG iterations: {round(avgApgIterations, 2)}')
 
+    # The SE loss of every quantized model is reported against its float model in the plots.
+    referenceAlgoDict = {}
+    for algoName in algoList:
+        if algoName.endswith(QUANTIZED_SUFFIX):
+            referenceAlgoDict[algoName] = algoName[:-len(QUANTIZED_SUFFIX)]
     performancePlotter(
                             resultsPath,
                             algoList,
                             simulationParameters.plotFolder,
-                            simulationParameters.scenario
+                            simulationParameters.scenario,
+                            referenceAlgoDict
                         )
     print(avgLatency)
     return avgLatency
@@ -1,5 +1,90 @@
 import torch
-import math
+
+
+# Pilot index of padded users. Any index >= Tp marks a padded user.
+PILOT_PAD = 255
+
+
+def getPhiCrossMat(pilotSequences, Tp):
+    # phiCrossMat b X K X K of the pilot indices b X K, built by comparing the indices. The pilots
+    # are orthonormal, so it is 1 for the pairs of users sharing a pilot and 0 otherwise.
+    userMask = pilotSequences < Tp
+    samePilot = pilotSequences.unsqueeze(2) == pilotSequences.unsqueeze(1)
+    samePilot = samePilot & userMask.unsqueeze(2) & userMask.unsqueeze(1)
+    return samePilot.to(dtype=torch.float32)
+
+
+def getPilotGroups(pilotSequences, Tp):
+    # The pilots are the orthonormal columns of phiOrth, so phiCrossMat[b, i, k] is 1 if users i and
+    # k share a pilot and 0 otherwise (or if either one is padded). Users sharing a pilot form a
+    # co-pilot group, and every kernel below works on the groups laid out as b X Tp X G, where G is
+    # the largest group size of the batch.
+    # pilotSequences b X K
+    # Returns
+    #   members     b X Tp X G : user index of each group slot (0 in empty slots)
+    #   memberMask  b X Tp X G : False in empty slots
+    #   slotIndex   b X K      : flat index of the slot of each user in Tp X G (0 for padded users)
+    #   userMask    b X K      : False for padded users
+    [B, K] = pilotSequences.shape
+    device = pilotSequences.device
+    userMask = pilotSequences < Tp
+    pilots = torch.where(userMask, pilotSequences.to(dtype=torch.int64), Tp)  # padded users -> Tp
+
+    counts = torch.zeros((B, Tp + 1), device=device, dtype=torch.int64)
+    counts.scatter_add_(1, pilots, torch.ones_like(pilots))
+    G = max(1, int(counts[:, :Tp].max()))
+
+    # rank of each user within its group, in the order of the users
+    users = torch.arange(K, device=device)
+    order = torch.argsort(pilots * K + users, dim=1)
+    groupStart = torch.cumsum(counts, dim=1) - counts
+    sortedRank = users - groupStart.gather(1, pilots.gather(1, order))
+    rank = torch.empty_like(pilots).scatter_(1, order, sortedRank)
+
+    # padded users go to a spare slot at the end, which is dropped
+    slotIndex = torch.where(userMask, pilots * G + rank, Tp * G)
+    members = torch.zeros((B, Tp * G + 1), device=device, dtype=torch.int64)
+    members.scatter_(1, slotIndex, users.expand(B, K))
+    memberMask = torch.zeros((B, Tp * G + 1), device=device, dtype=torch.bool)
+    memberMask.scatter_(1, slotIndex, userMask)
+
+    members = members[:, :-1].view(B, Tp, G)
+    memberMask = memberMask[:, :-1].view(B, Tp, G)
+    slotIndex = torch.where(userMask, slotIndex, 0)
+    return members, memberMask, slotIndex, userMask
+
+
+def toGroups(x, pilotGroups):
+    # b X K X ... -> b X Tp X G X ..., with arbitrary values in the empty slots
+    members = pilotGroups[0]
+    [B, Tp, G] = members.shape
+    flatIndex = members + x.shape[1] * torch.arange(B, device=x.device).view(-1, 1, 1)
+    return x.flatten(0, 1).index_select(0, flatIndex.view(-1)).view(B, Tp, G, *x.shape[2:])
+
+
+def toUsers(x, pilotGroups):
+    # b X Tp X G X ... -> b X K X ..., with arbitrary values for the padded users
+    slotIndex = pilotGroups[2]
+    [B, K] = slotIndex.shape
+    flatIndex = slotIndex + x.shape[1] * x.shape[2] * torch.arange(B, device=x.device).view(-1, 1)
+    return x.flatten(0, 2).index_select(0, flatIndex.view(-1)).view(B, K, *x.shape[3:])
+
+
+def compute_v_matPilots(betas, zeta_p, Tp, pilotSequences):
+    # Eq (5) with the co-pilot sums of the betas taken per pilot instead of through phiCrossMat
+    # betas b X M X K
+    # pilotSequences b X K
+    [B, M, K] = betas.shape
+    userMask = pilotSequences < Tp
+    pilots = torch.where(userMask, pilotSequences.to(dtype=torch.int64), Tp)
+    pilots = pilots.unsqueeze(1).expand(B, M, K)
+
+    pilotBetaSums = torch.zeros((B, M, Tp + 1), device=betas.device, dtype=betas.dtype)
+    pilotBetaSums.scatter_add_(2, pilots, betas)  # b X M X Tp+1
+    coPilotBetas = pilotBetaSums.gather(2, pilots) * userMask.unsqueeze(1)  # b X M X K
+
+    vMat = (zeta_p * Tp * (betas ** 2)) / (1 + zeta_p * Tp * coPilotBetas)
+    return vMat
 
 
 def compute_v_mat(betas, zeta_p, Tp, phiCrossMat):
@@ -42,29 +127,78 @@ def individualUtilityComputation(betas, mus, N, zeta_d, Tp, Tc, vMat, phiCrossMa
     return nu_mat_k, SE
 
 
-def computeSmoothMin(seVec, tau):
+def computeSmoothMin(seVec, tau, userWeights=None):
     # seVec is of dim either K 1 or b X K
-    seSmoothMin = -(1 / tau) * torch.log((torch.exp(-tau * seVec)).mean(dim=-1))
-    return seSmoothMin
+    # userWeights (same dim as seVec) weighs the users in the mean, e.g. to leave out padded users
+    if userWeights is None:
+        return -(1 / tau) * torch.log((torch.exp(-tau * seVec)).mean(dim=-1))
+    meanExp = (torch.exp(-tau * seVec) * userWeights).sum(dim=-1) / userWeights.sum(dim=-1)
+    return -(1 / tau) * torch.log(meanExp)
 
-def utilityComputation(betas, mus, N, geta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
-    K = betas.shape[-1]
-    se = torch.zeros((K,), device=device, requires_grad=False, dtype=torch.float32)
-    for k in range(K):
-        _, se[k] = individualUtilityComputation(
-                                                    betas,
-                                                    mus,
-                                                    N,
-                                                    geta_d,
-                                                    Tp,
-                                                    Tc,
-                                                    vMat,
-                                                    phiCrossMat,
-                                                    k
-                                                )  # Eq (16)
-    
-    if math.isnan(se.sum().item()):
-        print('Something went wrong! The utility is nan')
-        print(betas.sum().item(), mus.sum().item())
+def seComputation(betas, mus, N, zeta_d, Tp, Tc, phiCrossMat, vMat):
+    # Eq (16) and (17) for all the users at once, b X K. Same as individualUtilityComputation for
+    # every target user k.
+    # vMat b X M X K
+    # phiCrossMat b X K X K
+    # betas b X M X K
+    # mus b X M X K
+    aMat = torch.sqrt(vMat) / betas
+    return seComputationCached(betas, aMat, phiCrossMat**2, mus, N, zeta_d, Tp, Tc)
+
+def seComputationCached(betas, aMat, phiCrossMatSq, mus, N, zeta_d, Tp, Tc):
+    # seComputation on the mu-independent terms aMat = sqrt(vMat) / betas and phiCrossMat ** 2.
+    # nu_dot_mu[b, i] of user k is phiCrossMat[b, i, k] * G[b, i, k].
+    G = (aMat * mus).transpose(1, 2) @ betas  # b X K X K
+    bMat = zeta_d * phiCrossMatSq * G**2  # b X K X K
+    # (zeta_d / N) * sum_i sum_m mus[b, m, i]^2 * betas[b, m, k]
+    powTerm = (zeta_d / N) * torch.einsum('bm,bmk->bk', (mus ** 2).sum(dim=2), betas)  # b X K
+    b_plus_c = 1 / (N ** 2) + powTerm + bMat.sum(dim=1)
 
-    return [computeSmoothMin(se, tau), se]
\ No newline at end of file
+    b = torch.diagonal(bMat, dim1=1, dim2=2)  # b X K
+    gamma = b / (b_plus_c - b)
+    SE = (1 - Tp / Tc) * torch.log(1 + gamma)
+    return SE
+
+def groupSeTerms(betas, betasGroups, aMatGroups, pilotGroups, mus, N, zeta_d, Tp, Tc):
+    # Eq (16) and (17) per co-pilot group. For the users i and k in the slots g and h of pilot p,
+    # G[b, p, g, h] = sum_m (sqrt(vMat) / betas * mus)[b, m, i] * betas[b, m, k]. Users of different
+    # groups do not interfere coherently, so nothing else of the K X K matrix is needed.
+    # betasGroups and aMatGroups are betas and sqrt(vMat) / betas grouped by toGroups,
+    # b X Tp X G X M.
+    # Returns G and b_plus_c, b, SE b X Tp X G. G is 0 in the empty slots, so are b and SE.
+    memberMask = pilotGroups[1]
+    aMusGroups = aMatGroups * toGroups(mus.transpose(1, 2), pilotGroups)  # b X Tp X G X M
+    G = aMusGroups @ betasGroups.transpose(2, 3)  # b X Tp X G X G
+    G = G * (memberMask.unsqueeze(3) & memberMask.unsqueeze(2))
+    bMat = zeta_d * G**2
+
+    # (zeta_d / N) * sum_i sum_m mus[b, m, i]^2 * betas[b, m, k] over all the users i
+    powTerm = (zeta_d / N) * torch.einsum('bm,bmk->bk', (mus ** 2).sum(dim=2), betas)  # b X K
+    b_plus_c = 1 / (N ** 2) + toGroups(powTerm, pilotGroups) + bMat.sum(dim=2)  # b X Tp X G
+
+    b = torch.diagonal(bMat, dim1=2, dim2=3)  # b X Tp X G
+    gamma = b / (b_plus_c - b)
+    SE = (1 - Tp / Tc) * torch.log(1 + gamma)
+    return G, b_plus_c, b, SE
+
+def seComputationPilots(betas, mus, N, zeta_d, Tp, Tc, pilotGroups, vMat):
+    # Same as seComputation, at a cost of O(b M K G) instead of O(b M K^2), b X K.
+    # Padded users get an SE of 0.
+    aMat = torch.sqrt(vMat) / betas
+    *_, SE = groupSeTerms(
+                            betas,
+                            toGroups(betas.transpose(1, 2), pilotGroups),
+                            toGroups(aMat.transpose(1, 2), pilotGroups),
+                            pilotGroups,
+                            mus,
+                            N,
+                            zeta_d,
+                            Tp,
+                            Tc
+                        )
+    return toUsers(SE, pilotGroups) * pilotGroups[3]
+
+def utilityComputation(betas, mus, N, geta_d, Tp, Tc, phiCrossMat, vMat, tau, device):
+    # Returns the smooth-min utility b and the SEs b X K of a whole batch
+    se = seComputation(betas, mus, N, geta_d, Tp, Tc, phiCrossMat, vMat)  # Eq (16)
+    return [computeSmoothMin(se, tau), se]
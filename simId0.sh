@@ -7,6 +7,10 @@
 #SBATCH --output=simId0.out
 #SBATCH --tmp=1T
 
+# This run trains on a stored set of numberOfSamples samples (stream=0), the setting of the
+# published results. stream=1 would generate fresh samples every epoch instead, with no scratch
+# space needed.
+
 triton=1  # do not change
 operationMode=1  # do not change
 
@@ -19,8 +23,9 @@ retain=0
 numberOfSamples=100000
 varK=0
 randomPilotsFlag=0
+stream=0  # 1 generates fresh samples every epoch instead of storing numberOfSamples of them
 
 module load mamba
 source activate CFmMIMO_PC
 
-python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag
\ No newline at end of file
+python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag --stream $stream
\ No newline at end of file
@@ -5,7 +5,10 @@
 #SBATCH --cpus-per-task=1
 #SBATCH --gres=gpu:v100:1
 #SBATCH --output=simId2.out
-#SBATCH --tmp=1T
+
+# The training and validation samples are generated on the fly in the DataLoader workers (stream=1),
+# so neither scratch space nor an up-front data generation is needed. numberOfSamples is the
+# number of fresh samples per epoch.
 
 triton=1  # do not change
 operationMode=1  # do not change
@@ -19,8 +22,9 @@ retain=0
 numberOfSamples=12000000
 varK=0
 randomPilotsFlag=0
+stream=1  # 0 generates and stores numberOfSamples samples before training (needs --tmp=1T)
 
 module load mamba
 source activate CFmMIMO_PC
 
-python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag
\ No newline at end of file
+python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag --stream $stream
\ No newline at end of file
@@ -7,6 +7,10 @@
 #SBATCH --output=simId5.out
 #SBATCH --tmp=1T
 
+# This run trains on a stored set of numberOfSamples samples (stream=0). With a single CPU per
+# task, generating the samples of this scenario on the fly every epoch would hold back the GPU.
+# stream=1 (with more --cpus-per-task and --workers) would need no scratch space.
+
 triton=1  # do not change
 operationMode=1  # do not change
 
@@ -19,8 +23,9 @@ retain=0
 numberOfSamples=12000000
 varK=1
 randomPilotsFlag=0
+stream=0  # 1 generates fresh samples every epoch instead of storing numberOfSamples of them
 
 module load mamba
 source activate CFmMIMO_PC
 
-python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag
\ No newline at end of file
+python cellFreeMassMimoPowCtrl.py --simulationId $simId --samples $numberOfSamples --mode $operationMode --scenario $scenario --retain $retain --host $triton --varK $varK --randomPilotsFlag $randomPilotsFlag --stream $stream
\ No newline at end of file
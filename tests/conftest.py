@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def parameters(tmp_path_factory):
+    # SimulationParameters and SystemParameters of scenario 0 with a varying number of users, in a
+    # temporary root folder
+    from utils.handleInputArgs import Args
+    from parameters.simParams import SimulationParameters
+    from parameters.sysParams import SystemParameters
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(sys, 'argv', ['cellFreeMassMimoPowCtrl.py', '-m', '1', '-sc', '0',
+                                          '-v', '1', '-s', '16'])
+        args = Args(16)
+    args.preProcessArgs(64)
+    args.setRootDir()
+    args.root = str(tmp_path_factory.mktemp('root'))
+
+    simulationParameters = SimulationParameters(args)
+    systemParameters = SystemParameters(simulationParameters)
+    return simulationParameters, systemParameters
+
+
+@pytest.fixture(scope='session')
+def models(parameters):
+    # Untrained models of the scenario, so no checkpoint is needed
+    from powerControl.gradientHandler import grads
+    from powerControl.models.utils import initializeHyperParams, loadTheLatestModelAndParamsIfExists
+    simulationParameters, systemParameters = parameters
+
+    models = {}
+    for modelName in systemParameters.models:
+        initializeHyperParams(modelName, simulationParameters, systemParameters)
+        models[modelName] = loadTheLatestModelAndParamsIfExists(
+                                                                    modelName,
+                                                                    None,
+                                                                    systemParameters,
+                                                                    grads
+                                                                ).eval()
+    return models
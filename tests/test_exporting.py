@@ -0,0 +1,135 @@
+import importlib.util
+import inspect
+
+import pytest
+import torch
+
+from powerControl.exporting import (
+    EXPORT_TOLERANCE,
+    DeployableModel,
+    ModelCore,
+    checkExportedModel,
+    exportModel,
+    exportOnnx,
+    getCheckSamples,
+    loadExportedModel,
+)
+from powerControl.models.rootModel import PAD_CONST
+from powerControl.models.utils import deploy
+
+
+BATCH_SIZES = [1, 5, 16]
+
+
+@pytest.fixture(scope='module')
+def samples(parameters):
+    return getCheckSamples(*parameters)
+
+
+def randomInputs(systemParameters, batchSize, numberOfUsers):
+    # Linear betas in the range of the generated ones and valid pilot indices
+    logBetas = torch.empty(batchSize, systemParameters.numberOfAccessPoints, numberOfUsers)
+    betas = torch.exp(logBetas.uniform_(-36, -14))
+    pilotSequences = torch.randint(0, systemParameters.Tp, (batchSize, numberOfUsers))
+    return betas, pilotSequences
+
+
+def deployMus(model, modelName, betas, pilotSequences, numberOfUsers):
+    # The mus of deploy, sample by sample, on the first numberOfUsers[b] users of every sample b
+    device = torch.device('cpu')
+    return [
+                deploy(
+                        model,
+                        betas[b:b + 1, :, :numberOfUsers[b]],
+                        pilotSequences[b:b + 1, :numberOfUsers[b]],
+                        modelName,
+                        device
+                    )
+                for b in range(len(numberOfUsers))
+            ]
+
+
+def maxDifference(batchMus, mus, numberOfUsers):
+    return max(
+                (batchMus[b:b + 1, :, :numberOfUsers[b]] - mus[b]).abs().max().item()
+                for b in range(len(numberOfUsers))
+            )
+
+
+def test_checkSamplesVaryTheNumberOfUsers(samples):
+    assert len(samples[2].unique()) > 1
+
+
+@pytest.mark.parametrize('modelName', ['TNN', 'FCN'])
+def test_exportedModelMatchesDeploy(parameters, models, samples, modelName, tmp_path):
+    _, systemParameters = parameters
+    model = models[modelName]
+    assert exportModel(model, modelName, systemParameters, samples, str(tmp_path)) is not None
+    exportedModel, meta = loadExportedModel(str(tmp_path), modelName)
+    assert meta['maxDifference'] <= EXPORT_TOLERANCE
+
+    # Batches of samples with the same number of users K, padded by the exported model
+    for batchSize in BATCH_SIZES:
+        for K in range(1, systemParameters.maxNumberOfUsers + 1):
+            betas, pilotSequences = randomInputs(systemParameters, batchSize, K)
+            with torch.no_grad():
+                batchMus = exportedModel(betas, pilotSequences)
+            assert batchMus.shape == (batchSize, systemParameters.numberOfAccessPoints, K)
+            mus = deployMus(model, modelName, betas, pilotSequences, [K] * batchSize)
+            assert maxDifference(batchMus, mus, [K] * batchSize) <= EXPORT_TOLERANCE
+
+    # A batch of samples with varying K, padded with PILOT_PAD and PAD_CONST
+    assert checkExportedModel(model, exportedModel, modelName, samples) <= EXPORT_TOLERANCE
+
+
+@pytest.mark.parametrize('dynamo', [True, False])
+@pytest.mark.parametrize('modelName', ['TNN', 'FCN'])
+def test_onnxModelMatchesDeploy(parameters, models, samples, modelName, dynamo, tmp_path):
+    pytest.importorskip('onnx')
+    onnxruntime = pytest.importorskip('onnxruntime')
+    if dynamo:
+        pytest.importorskip('onnxscript')
+        if 'dynamo' not in inspect.signature(torch.onnx.export).parameters:
+            pytest.skip('torch.onnx.export has no dynamo exporter')
+
+    _, systemParameters = parameters
+    model = models[modelName]
+    onnxModel = DeployableModel(
+                                    ModelCore(model),
+                                    systemParameters.maxNumberOfUsers,
+                                    systemParameters.Tp,
+                                    PAD_CONST
+                                )
+    filePath = str(tmp_path / f'{modelName}.onnx')
+    assert exportOnnx(onnxModel, filePath, samples, dynamo=dynamo) <= EXPORT_TOLERANCE
+    session = onnxruntime.InferenceSession(filePath, providers=['CPUExecutionProvider'])
+
+    def runOnnx(betas, pilotSequences):
+        inputs = {'betas': betas.numpy(), 'pilotSequences': pilotSequences.to(torch.int64).numpy()}
+        return torch.from_numpy(session.run(None, inputs)[0])
+
+    # The ONNX model takes the maximum number of users only, for any batch size.
+    K = systemParameters.maxNumberOfUsers
+    for batchSize in BATCH_SIZES:
+        betas, pilotSequences = randomInputs(systemParameters, batchSize, K)
+        mus = deployMus(model, modelName, betas, pilotSequences, [K] * batchSize)
+        assert maxDifference(runOnnx(betas, pilotSequences), mus, [K] * batchSize) \
+            <= EXPORT_TOLERANCE
+
+    betas, pilotSequences, numberOfUsers = samples
+    mus = deployMus(model, modelName, betas, pilotSequences, numberOfUsers)
+    assert maxDifference(runOnnx(betas, pilotSequences), mus, numberOfUsers) <= EXPORT_TOLERANCE
+
+
+def test_onnxIsSkippedWithoutOnnx(parameters, models, samples, tmp_path, monkeypatch):
+    # Without onnx only the TorchScript module is exported.
+    findSpec = importlib.util.find_spec
+    monkeypatch.setattr(
+                            importlib.util,
+                            'find_spec',
+                            lambda name, *args: None if name == 'onnx' else findSpec(name, *args)
+                        )
+    _, systemParameters = parameters
+    meta = exportModel(models['FCN'], 'FCN', systemParameters, samples, str(tmp_path))
+    assert meta['onnx'] is None
+    assert not (tmp_path / 'FCN.onnx').exists()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from utils.resultsStore import resultsDtype
+from utils.utils import folderLock
+
+
+# Results of the algos that do not depend on a trained model (EPA and APG), shared by all the
+# test runs on the same test data. An algo has one records file per key, in the format of
+# results.npy restricted to that algo, with the key stored next to it. The sample i of the
+# records is the sample i of the test data. Only the SEs and the numbers of APG iterations are
+# shared: the latencies depend on the machine and the number of threads, so every run times its
+# own samples.
+BASELINE_CACHE_FOLDER = 'baselineCache'
+
+
+def baselineCacheKey(algoName, algoVersion, dataConfig, systemConstants, algoConfig=None):
+    # dataConfig is the config of the test data manifest. Every sample is generated from a seed
+    # of its index and of this config, so the config identifies the content of the test data.
+    return {
+                'algo': algoName,
+                'algoVersion': algoVersion,
+                'algoConfig': algoConfig,
+                'data': dataConfig,
+                'system': systemConstants,
+            }
+
+
+def baselineCachePaths(cacheRoot, key):
+    keyHash = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    cacheFolder = os.path.join(cacheRoot, BASELINE_CACHE_FOLDER)
+    filePath = os.path.join(cacheFolder, f'{key["algo"]}{keyHash}')
+    return f'{filePath}.npy', f'{filePath}.json'
+
+
+def loadCachedRecords(cacheRoot, key):
+    recordsPath, keyPath = baselineCachePaths(cacheRoot, key)
+    if not (os.path.isfile(recordsPath) and os.path.isfile(keyPath)):
+        return None
+    with open(keyPath, 'r') as file:
+        if json.load(file) != key:
+            return None
+    return np.load(recordsPath, mmap_mode='r')
+
+
+def restoreFromCache(cacheRoot, key, resultsWriter):
+    # Copies the cached SEs of the algo of key to the samples of resultsWriter that miss them,
+    # without their latencies. Returns the number of samples whose SEs were restored.
+    cachedRecords = loadCachedRecords(cacheRoot, key)
+    if cachedRecords is None:
+        return 0
+
+    algoName = key['algo']
+    records = resultsWriter.records
+    numberOfSamples = min(len(records), len(cachedRecords))
+    cachedRecords = np.array(cachedRecords[:numberOfSamples])
+
+    restore = cachedRecords[f'{algoName}Done'] & ~records[f'{algoName}Done'][:numberOfSamples]
+    restoreIndex = np.nonzero(restore)[0]
+    for field in [f'{algoName}Se', 'numberOfUsers', f'{algoName}Done']:
+        records[field][restoreIndex] = cachedRecords[field][restoreIndex]
+    if algoName == 'APG':
+        records['apgIterations'][restoreIndex] = cachedRecords['apgIterations'][restoreIndex]
+    return len(restoreIndex)
+
+
+def saveToCache(cacheRoot, key, resultsWriter):
+    # Adds the SEs of the algo of key in resultsWriter that the cache misses. The cache files are
+    # replaced atomically under a lock, so concurrent runs may share them.
+    algoName = key['algo']
+    records = resultsWriter.records
+    recordsPath, keyPath = baselineCachePaths(cacheRoot, key)
+    os.makedirs(os.path.dirname(recordsPath), exist_ok=True)
+
+    with folderLock(recordsPath):
+        cachedRecords = loadCachedRecords(cacheRoot, key)
+        numberOfCachedSamples = 0 if cachedRecords is None else len(cachedRecords)
+        numberOfSamples = max(numberOfCachedSamples, len(records))
+
+        dtype = resultsDtype([algoName], resultsWriter.maxNumberOfUsers)
+        newRecords = np.zeros((numberOfSamples,), dtype=dtype)
+        newRecords['apgIterations'] = -1
+        newRecords[f'{algoName}Latency'] = np.nan
+        if cachedRecords is not None:
+            newRecords[:numberOfCachedSamples] = cachedRecords
+
+        add = records[f'{algoName}Done'] & ~newRecords[f'{algoName}Done'][:len(records)]
+        addIndex = np.nonzero(add)[0]
+        for field in [f'{algoName}Se', 'numberOfUsers', f'{algoName}Done']:
+            newRecords[field][addIndex] = records[field][addIndex]
+        if algoName == 'APG':
+            newRecords['apgIterations'][addIndex] = records['apgIterations'][addIndex]
+
+        if len(addIndex) == 0:
+            return
+
+        tempKeyPath = f'{keyPath}.{os.getpid()}.tmp'
+        with open(tempKeyPath, 'w') as file:
+            json.dump(key, file, indent=1)
+        os.replace(tempKeyPath, keyPath)
+
+        tempRecordsPath = f'{recordsPath}.{os.getpid()}.tmp.npy'
+        np.save(tempRecordsPath, newRecords)
+        os.replace(tempRecordsPath, recordsPath)
@@ -83,7 +83,13 @@ class Args():
                     5) CONSOL             : This is for generating consolidated plots once all the
                     results of all the simIds are ready.\n
                     6) LOCAL              : To Fetch the consolidated plots and do additional
-                    processing like annotation.\n""",
+                    processing like annotation.\n
+                    7) BENCHMARK          : Generates testing data if needed and measures the
+                    latency of all the algos over several batch sizes.\n
+                    8) SERVE              : Loads the trained models once and serves their power
+                    coefficients and SEs over HTTP on the local host.\n
+                    9) EXPORT             : Exports the trained models as TorchScript (and ONNX)
+                    files that load without pytorch_lightning.\n""",
                 default=OperatingModes.ALL,
                 metavar='operatingMode',
             )
@@ -125,6 +131,133 @@ class Args():
                 metavar='minK',
             )
 
+        parser.add_argument(
+                '-df',
+                '--dataFormat',
+                choices={"0", "1"},
+                help=('Choose 1 to store the data as memory-mapped shards and choose 0 for one file'
+                      ' per sample.'),
+                default="1",
+                metavar='dataFormat',
+            )
+
+        parser.add_argument(
+                '-be',
+                '--betaEncoding',
+                choices={"0", "1", "2"},
+                help=('Encoding of the betas in the sharded data format. 0 for float32, 1 for'
+                      ' log-domain float16 (up to 1.6% relative error on the betas) and 2 for'
+                      ' log-domain int16 (below 0.05%). Default 0.'),
+                default="0",
+                metavar='betaEncoding',
+            )
+
+        parser.add_argument(
+                '-w',
+                '--workers',
+                type=checkPositive,
+                help=('Number of processes used for data generation. The generated data does not'
+                      ' depend on it. Default 1.'),
+                default="1",
+                metavar='numberOfWorkers',
+            )
+
+        parser.add_argument(
+                '-st',
+                '--stream',
+                choices={"0", "1"},
+                help=('Choose 1 to generate the training and validation samples on the fly inside'
+                      ' the DataLoader workers instead of storing them. --samples then sets the'
+                      ' number of fresh samples per epoch. Valid only for TRAINING phase.'),
+                default="0",
+                metavar='streamingDataFlag',
+            )
+
+        parser.add_argument(
+                '-at',
+                '--apgTolerance',
+                choices={"0", "1"},
+                help=('Choose 1 to stop APG once its utility or its power coefficients stop'
+                      ' changing and choose 0 to always run all of its iterations. Valid only for'
+                      ' TESTING phase.'),
+                default="0",
+                metavar='apgToleranceFlag',
+            )
+
+        parser.add_argument(
+                '-ri',
+                '--refineIterations',
+                type=checkNonNegative,
+                help=('Number of APG iterations run from the output of each deep learning model,'
+                      ' which is tested as an extra algo, e.g. TNN+APG. 0 (default) to skip them.'
+                      ' Valid only for TESTING phase.'),
+                default="0",
+                metavar='refineIterations',
+            )
+
+        parser.add_argument(
+                '-q',
+                '--quantize',
+                choices={"0", "1"},
+                help=('Choose 1 to also test int8 dynamically quantized copies of the deep learning'
+                      ' models as extra algos, e.g. TNN-INT8, and 0 (default) to skip them. Valid'
+                      ' only for TESTING and BENCHMARK phases.'),
+                default="0",
+                metavar='quantizeFlag',
+            )
+
+        parser.add_argument(
+                '-tb',
+                '--testBatchSize',
+                type=checkNonNegative,
+                help=('Choose a positive batch size to run the algos on whole batches of test'
+                      ' samples and 0 (default) to run them sample by sample. In batches, the'
+                      ' latency is measured separately on the first samples. Valid only for'
+                      ' TESTING phase.'),
+                default="0",
+                metavar='testBatchSize',
+            )
+
+        parser.add_argument(
+                '-th',
+                '--threads',
+                type=checkNonNegative,
+                help=('Number of threads used by torch. 0 (default) keeps the torch default.'),
+                default="0",
+                metavar='numberOfThreads',
+            )
+
+        parser.add_argument(
+                '-po',
+                '--port',
+                type=checkNonNegative,
+                help=('Port of the power control server. Valid only for SERVE phase.'),
+                default="8000",
+                metavar='port',
+            )
+
+        parser.add_argument(
+                '-sp',
+                '--socketPort',
+                type=checkNonNegative,
+                help=('Port of the binary socket protocol of the power control server, a faster'
+                      ' alternative to HTTP. 0 turns it off. Valid only for SERVE phase.'),
+                default="8001",
+                metavar='socketPort',
+            )
+
+        parser.add_argument(
+                '-mw',
+                '--maxWait',
+                type=checkNonNegative,
+                help=('Maximum time in microseconds a request to the power control server waits'
+                      ' for other requests to be batched with it. 0 (default) batches only the'
+                      ' requests that arrived while the previous batch was running. Valid only'
+                      ' for SERVE phase.'),
+                default="0",
+                metavar='maxWait',
+            )
+
         parser.add_argument(
                 '-ho',
                 '--host',
@@ -138,8 +271,10 @@ class Args():
                 '-re',
                 '--retain',
                 choices={"0", "1"},
-                help=('Choose 1 to retain the input data for training and choose 0 for overwriting'
-                      'it.'),
+                help=('Choose 1 (default) to retain the data and results folders and 0 to overwrite'
+                      ' them. Retained data is resumed or extended, and retained test results are'
+                      ' resumed for the algos whose data, APG settings and trained models did not'
+                      ' change.'),
                 default="1",
                 metavar='retainData',
             )
@@ -163,6 +298,18 @@ class Args():
             self.randomPilotsFlag,
             self.varyingNumberOfUsersFlag,
             self.minNumberOfUsersFlag,
+            self.shardedDataFlag,
+            self.betaEncoding,
+            self.numberOfWorkers,
+            self.streamingDataFlag,
+            self.apgToleranceFlag,
+            self.refineIterations,
+            self.quantizeFlag,
+            self.testBatchSize,
+            self.numberOfThreads,
+            self.port,
+            self.socketPort,
+            self.maxWait,
             self.host,
             self.retain,
             self.clean
@@ -174,6 +321,18 @@ class Args():
                 args.randomPilotsFlag,
                 args.varK,
                 args.minK,
+                args.dataFormat,
+                args.betaEncoding,
+                args.workers,
+                args.stream,
+                args.apgTolerance,
+                args.refineIterations,
+                args.quantize,
+                args.testBatchSize,
+                args.threads,
+                args.port,
+                args.socketPort,
+                args.maxWait,
                 args.host,
                 args.retain,
                 args.clean
@@ -199,6 +358,10 @@ class Args():
         self.retain = (self.retain==1)  # Translating {0, 1} to {False, True}
         self.randomPilotsFlag = (self.randomPilotsFlag == 1)
         self.varyingNumberOfUsersFlag = (self.varyingNumberOfUsersFlag == 1)
+        self.shardedDataFlag = (self.shardedDataFlag == 1)
+        self.streamingDataFlag = (self.streamingDataFlag == 1)
+        self.apgToleranceFlag = (self.apgToleranceFlag == 1)
+        self.quantizeFlag = (self.quantizeFlag == 1)
         
     
     def setRootDir(self):
@@ -211,13 +374,13 @@ class Args():
             userId = pwd.getpwuid(os.getuid())[0]
             currentFolderForTriton = cwd.split('/')[-1]
             rootBase = os.path.join('/tmp', f'hsperfdata_{userId}')
-            handleDeletionAndCreation(rootBase, forceRetain=True)
+            handleDeletionAndCreation(rootBase, retain=True)
 
             root = os.path.join('/tmp', f'hsperfdata_{userId}', currentFolderForTriton)
-            handleDeletionAndCreation(root, forceRetain=True)
+            handleDeletionAndCreation(root, retain=True)
 
             resultsBase = os.path.join('/scratch', 'work', userId, currentFolderForTriton)
-            handleDeletionAndCreation(resultsBase, forceRetain=True)
+            handleDeletionAndCreation(resultsBase, retain=True)
         else:
             root = cwd
             resultsBase = None
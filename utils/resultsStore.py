@@ -0,0 +1,214 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+# Results of a test run, in its results folder:
+#   resultsMeta.json : format version, algos, number of samples, maximum K and the configs the
+#                      results depend on
+#   results.npy      : structured array with one record per test sample. Its fields are
+#                      'numberOfUsers', the K of the sample, 'apgIterations', the number of APG
+#                      iterations (-1 if APG did not run), and for every algo
+#                        '{algo}Se'      : per-user SE in bits/sec/Hz, padded with 0 beyond K
+#                        '{algo}Latency' : latency in seconds, NaN if it was not measured
+#                        '{algo}Done'    : True once the SE of the sample is written
+# The records are written in place through a memory map while testing, and read through a
+# read-only memory map for plotting. A run with the same configs resumes the records of an
+# interrupted one, so only the missing samples and algos are computed.
+RESULTS_FILE = 'results.npy'
+RESULTS_META_FILE = 'resultsMeta.json'
+RESULTS_FORMAT_VERSION = 2
+
+
+def resultsDtype(algoList, maxNumberOfUsers):
+    fields = [('numberOfUsers', np.int32), ('apgIterations', np.int32)]
+    for algoName in algoList:
+        fields += [
+                    (f'{algoName}Se', np.float32, (maxNumberOfUsers,)),
+                    (f'{algoName}Latency', np.float64),
+                    (f'{algoName}Done', np.bool_),
+                ]
+    return np.dtype(fields)
+
+
+def loadResultsMeta(folder):
+    metaPath = os.path.join(folder, RESULTS_META_FILE)
+    if not os.path.isfile(metaPath):
+        return None
+    with open(metaPath, 'r') as file:
+        return json.load(file)
+
+
+class ResultsWriter:
+
+    def __init__(
+                    self,
+                    folder,
+                    algoList,
+                    numberOfSamples,
+                    maxNumberOfUsers,
+                    config=None,
+                    algoConfigs=None
+                ):
+        # config is a JSON-serializable dict of everything the results of all the algos depend on,
+        # and algoConfigs maps an algo to the settings only its results depend on. The records of
+        # an earlier run with the same config and maximum K are kept, and extended to new algos
+        # or samples, except those of the algos whose settings changed. Otherwise the records
+        # start empty.
+        self.folder = folder
+        self.algoList = list(algoList)
+        self.maxNumberOfUsers = maxNumberOfUsers
+        algoConfigs = {} if algoConfigs is None else algoConfigs
+
+        resultsPath = os.path.join(folder, RESULTS_FILE)
+        meta = loadResultsMeta(folder)
+        resumable = (
+                        meta is not None
+                        and meta['version'] == RESULTS_FORMAT_VERSION
+                        and meta['maxNumberOfUsers'] == maxNumberOfUsers
+                        and meta['config'] == config
+                        and os.path.isfile(resultsPath)
+                    )
+        staleAlgoList = []
+        if resumable:
+            self.algoList += [algoName for algoName in meta['algoList'] if algoName not in algoList]
+            staleAlgoList = [
+                                algoName for algoName in meta['algoList']
+                                if algoName in algoConfigs
+                                and meta['algoConfigs'].get(algoName) != algoConfigs[algoName]
+                            ]
+            algoConfigs = {**meta['algoConfigs'], **algoConfigs}
+            if staleAlgoList:
+                print(f'Discarding the stored results of {staleAlgoList}: their settings or '
+                      f'trained models changed.')
+
+        if resumable and not staleAlgoList and meta['algoList'] == self.algoList \
+                and meta['numberOfSamples'] == numberOfSamples:
+            self.records = np.lib.format.open_memmap(resultsPath, mode='r+')
+        else:
+            # The records are rebuilt in a temporary file, so an interruption leaves the old ones.
+            tempResultsPath = f'{resultsPath}.{os.getpid()}.tmp.npy'
+            dtype = resultsDtype(self.algoList, maxNumberOfUsers)
+            records = np.lib.format.open_memmap(
+                                                    tempResultsPath,
+                                                    mode='w+',
+                                                    dtype=dtype,
+                                                    shape=(numberOfSamples,)
+                                                )
+            records['apgIterations'] = -1
+            for algoName in self.algoList:
+                records[f'{algoName}Latency'] = np.nan
+            if resumable:
+                staleFields = [
+                                f'{algoName}{suffix}' for algoName in staleAlgoList
+                                for suffix in ['Se', 'Latency', 'Done']
+                            ]
+                if 'APG' in staleAlgoList:
+                    staleFields.append('apgIterations')
+                oldRecords = np.load(resultsPath, mmap_mode='r')
+                commonSamples = min(numberOfSamples, len(oldRecords))
+                for field in oldRecords.dtype.names:
+                    if field not in staleFields:
+                        records[field][:commonSamples] = oldRecords[field][:commonSamples]
+                del oldRecords
+            records.flush()
+            del records
+            os.replace(tempResultsPath, resultsPath)
+            self.records = np.lib.format.open_memmap(resultsPath, mode='r+')
+
+        meta = {
+                    'version': RESULTS_FORMAT_VERSION,
+                    'algoList': self.algoList,
+                    'numberOfSamples': numberOfSamples,
+                    'maxNumberOfUsers': maxNumberOfUsers,
+                    'seUnit': 'bits/sec/Hz',
+                    'config': config,
+                    'algoConfigs': algoConfigs,
+                }
+        metaPath = os.path.join(folder, RESULTS_META_FILE)
+        tempMetaPath = f'{metaPath}.{os.getpid()}.tmp'
+        with open(tempMetaPath, 'w') as file:
+            json.dump(meta, file, indent=1)
+        os.replace(tempMetaPath, metaPath)
+
+    def write(self, algoName, start, se=None, numberOfUsers=None, latency=None, apgIterations=None):
+        # Writes the samples start, ..., start + b - 1 of algoName
+        # se b X K padded SEs in bits/sec/Hz and numberOfUsers b
+        # latency b in seconds
+        # apgIterations b numbers of APG iterations
+        if se is not None:
+            se = torch.as_tensor(se).to(device='cpu', dtype=torch.float32).numpy()
+            stop = start + se.shape[0]
+            numberOfUsers = np.asarray(numberOfUsers, dtype=np.int32)
+            userMask = np.arange(se.shape[1]) < numberOfUsers[:, None]
+
+            seColumn = np.zeros((se.shape[0], self.maxNumberOfUsers), dtype=np.float32)
+            seColumn[:, :se.shape[1]] = np.where(userMask, se, 0)
+            self.records[f'{algoName}Se'][start:stop] = seColumn
+            self.records['numberOfUsers'][start:stop] = numberOfUsers
+            if apgIterations is not None:
+                apgIterations = np.asarray(apgIterations, dtype=np.int32)
+                self.records['apgIterations'][start:stop] = apgIterations
+            self.records[f'{algoName}Done'][start:stop] = True
+        if latency is not None:
+            latency = np.asarray(latency, dtype=np.float64)
+            self.records[f'{algoName}Latency'][start:start + len(latency)] = latency
+
+    def pendingAlgos(self, algoList, start, stop=None, latency=False):
+        # The algos of algoList whose SE (or latency) is missing for any of the samples
+        # start, ..., stop - 1
+        stop = start + 1 if stop is None else stop
+        if latency:
+            return [
+                        algoName for algoName in algoList
+                        if np.isnan(self.records[f'{algoName}Latency'][start:stop]).any()
+                    ]
+        return [
+                    algoName for algoName in algoList
+                    if not self.records[f'{algoName}Done'][start:stop].all()
+                ]
+
+    def averageLatency(self, algoName):
+        # Over all the timed samples, including those of the earlier runs that were resumed
+        latency = np.array(self.records[f'{algoName}Latency'])
+        latency = latency[~np.isnan(latency)]
+        return latency.mean().item() if len(latency) > 0 else 0
+
+    def averageApgIterations(self):
+        apgIterations = np.array(self.records['apgIterations'])
+        apgIterations = apgIterations[apgIterations >= 0]
+        return apgIterations.mean().item() if len(apgIterations) > 0 else 0
+
+    def flush(self):
+        self.records.flush()
+
+
+class ResultsReader:
+
+    def __init__(self, folder, meta):
+        self.algoList = meta['algoList']
+        self.records = np.load(os.path.join(folder, RESULTS_FILE), mmap_mode='r')
+
+    def getSe(self, algoName, seMin):
+        # The worst user SE of every sample, or the SEs of all the users of all the samples, of the
+        # samples of algoName that are done
+        done = np.array(self.records[f'{algoName}Done'])
+        se = torch.from_numpy(np.array(self.records[f'{algoName}Se'][done]))
+        numberOfUsers = torch.from_numpy(np.array(self.records['numberOfUsers'][done]))
+        userMask = torch.arange(se.shape[1]) < numberOfUsers.view(-1, 1)
+        if seMin:
+            return torch.where(userMask, se, torch.inf).min(dim=1).values
+        return se[userMask]
+
+    def getLatency(self, algoName):
+        return torch.from_numpy(np.array(self.records[f'{algoName}Latency']))
+
+
+def openResultsReader(folder):
+    # Returns None for the folders of older runs, which hold one file per algo and sample.
+    meta = loadResultsMeta(folder)
+    if meta is None:
+        return None
+    return ResultsReader(folder, meta)
@@ -0,0 +1,208 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+# Sharded on-disk format of a data folder:
+#   manifest.json              : format version, generation config, beta encoding and the list of
+#                                complete shards
+#   shard{j}Betas.npy          : count X M X K_max encoded betas, padded beyond the K of each sample
+#   shard{j}Pilots.npy         : uint8 pilot indices of all the users of the shard (ragged)
+#   shard{j}Offsets.npy        : count + 1 offsets into shard{j}Pilots.npy
+# Shard j holds the samples j*shardSize, ..., j*shardSize + count - 1. Only the shards listed in
+# the manifest are complete, so the manifest is the commit record of the data generation.
+# The 'files' format keeps one 'betasSample{i}.pt' file per sample and uses the manifest only to
+# record which shard-sized ranges of samples are complete.
+MANIFEST_FILE = 'manifest.json'
+SHARD_FORMAT_VERSION = 1
+SHARD_MAX_ELEMENTS = 2**24  # ~64 MB of float32 betas per shard
+
+# Beta encodings:
+#   float32    : linear betas
+#   logFloat16 : log(betas) in float16. The spacing of float16 grows with |log(betas)|, so the
+#                relative error on the betas is below 0.4% for |log(betas)| < 16, 0.8% below 32
+#                and 1.6% below 64. The typical betas have |log(betas)| of about 14 to 36, so
+#                logInt16, of the same size, is more accurate.
+#   logInt16   : round((log(betas) - LOG_INT16_OFFSET) / LOG_INT16_SCALE) in int16. Covers betas
+#                from about -269 dB to 8 dB with a relative error below 0.05%.
+BETA_ENCODINGS = ['float32', 'logFloat16', 'logInt16']
+LOG_INT16_OFFSET = -30.0
+LOG_INT16_SCALE = 2**-10
+
+
+def encodeBetas(betas, betaEncoding):
+    if betaEncoding == 'float32':
+        return betas.to(dtype=torch.float32).numpy()
+
+    logBetas = torch.log(betas.clamp(min=torch.finfo(torch.float32).tiny))
+    if betaEncoding == 'logFloat16':
+        return logBetas.to(dtype=torch.float16).numpy()
+    elif betaEncoding == 'logInt16':
+        quantized = torch.round((logBetas - LOG_INT16_OFFSET) / LOG_INT16_SCALE)
+        return quantized.clamp(-2**15, 2**15 - 1).to(dtype=torch.int16).numpy()
+    else:
+        raise ValueError(f'Unknown beta encoding {betaEncoding}')
+
+
+def decodeLogBetas(encodedBetas, betaEncoding):
+    encodedBetas = torch.from_numpy(np.array(encodedBetas))
+    if betaEncoding == 'float32':
+        return torch.log(encodedBetas)
+    elif betaEncoding == 'logFloat16':
+        return encodedBetas.to(dtype=torch.float32)
+    elif betaEncoding == 'logInt16':
+        return encodedBetas.to(dtype=torch.float32) * LOG_INT16_SCALE + LOG_INT16_OFFSET
+    else:
+        raise ValueError(f'Unknown beta encoding {betaEncoding}')
+
+
+def getShardSize(numberOfAccessPoints, maxNumberOfUsers):
+    return max(1, SHARD_MAX_ELEMENTS // (numberOfAccessPoints * maxNumberOfUsers))
+
+
+def shardFileNames(shardId):
+    return (
+                f'shard{shardId}Betas.npy',
+                f'shard{shardId}Pilots.npy',
+                f'shard{shardId}Offsets.npy',
+            )
+
+
+def writeShard(folder, shardId, betas, pilotSequences, numberOfUsers, betaEncoding='float32'):
+    # betas B X M X K, pilotSequences B X K and numberOfUsers B. Sample b keeps its first
+    # numberOfUsers[b] users.
+    betasFile, pilotsFile, offsetsFile = shardFileNames(shardId)
+
+    numberOfUsers = numberOfUsers.to(dtype=torch.int64)
+    userMask = torch.arange(betas.shape[-1]) < numberOfUsers.view(-1, 1)  # B X K
+    betas = torch.where(userMask.unsqueeze(1), betas, 1)
+    offsets = torch.cat((torch.zeros((1,), dtype=torch.int64), torch.cumsum(numberOfUsers, 0)))
+
+    np.save(os.path.join(folder, betasFile), encodeBetas(betas, betaEncoding))
+    pilots = pilotSequences[userMask].to(dtype=torch.uint8)
+    np.save(os.path.join(folder, pilotsFile), pilots.numpy())
+    np.save(os.path.join(folder, offsetsFile), offsets.numpy())
+    return {'id': shardId, 'count': betas.shape[0]}
+
+
+def countCompleteSamples(shards, shardSize):
+    # Number of samples in the contiguous run of complete shards starting from shard 0
+    numberOfSamples = 0
+    for expectedId, shard in enumerate(sorted(shards, key=lambda shard: shard['id'])):
+        if shard['id'] != expectedId:
+            break
+        numberOfSamples += shard['count']
+        if shard['count'] < shardSize:
+            break
+    return numberOfSamples
+
+
+def writeManifest(folder, config, shards):
+    # config holds everything the samples depend on, including the 'format', 'shardSize',
+    # 'numberOfAccessPoints', 'maxNumberOfUsers' and 'betaEncoding'. The manifest is replaced
+    # atomically, so an interrupted run never leaves a partially written one.
+    shards = sorted(shards, key=lambda shard: shard['id'])
+    manifest = {
+                    'format': config['format'],
+                    'version': SHARD_FORMAT_VERSION,
+                    'betaEncoding': config['betaEncoding'],
+                    'shardSize': config['shardSize'],
+                    'numberOfAccessPoints': config['numberOfAccessPoints'],
+                    'maxNumberOfUsers': config['maxNumberOfUsers'],
+                    'numberOfSamples': countCompleteSamples(shards, config['shardSize']),
+                    'config': config,
+                    'shards': shards,
+                }
+    manifestPath = os.path.join(folder, MANIFEST_FILE)
+    tempManifestPath = f'{manifestPath}.{os.getpid()}.tmp'
+    with open(tempManifestPath, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tempManifestPath, manifestPath)
+
+
+def loadManifest(folder):
+    manifestPath = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.isfile(manifestPath):
+        return None
+    with open(manifestPath, 'r') as file:
+        return json.load(file)
+
+
+class ShardedSampleReader:
+    # Memory maps the shards lazily, so each DataLoader worker opens its own maps.
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.shardSize = manifest['shardSize']
+        self.numberOfSamples = manifest['numberOfSamples']
+        self.betaEncoding = manifest.get('betaEncoding', 'float32')
+        self.shards = {}
+
+    def openShard(self, shardId):
+        if shardId not in self.shards:
+            self.shards[shardId] = tuple(
+                np.load(os.path.join(self.folder, fileName), mmap_mode='r')
+                for fileName in shardFileNames(shardId)
+            )
+        return self.shards[shardId]
+
+    def getEncodedSample(self, index):
+        shardId, localIndex = divmod(index, self.shardSize)
+        betas, pilots, offsets = self.openShard(shardId)
+        start, stop = offsets[localIndex], offsets[localIndex + 1]
+
+        pilotSequence = torch.from_numpy(np.array(pilots[start:stop])).to(dtype=torch.int64)
+        return betas[localIndex, :, :stop - start], pilotSequence
+
+    def getLogSample(self, index):
+        # Returns log(betas) M X K and the pilot sequence K
+        encodedBetas, pilotSequence = self.getEncodedSample(index)
+        return decodeLogBetas(encodedBetas, self.betaEncoding), pilotSequence
+
+    def getSample(self, index):
+        # Returns betas M X K and the pilot sequence K
+        encodedBetas, pilotSequence = self.getEncodedSample(index)
+        if self.betaEncoding == 'float32':
+            return torch.from_numpy(np.array(encodedBetas)), pilotSequence
+        return torch.exp(decodeLogBetas(encodedBetas, self.betaEncoding)), pilotSequence
+
+    def __len__(self):
+        return self.numberOfSamples
+
+    def __getstate__(self):
+        # Memory maps are re-opened in the receiving process.
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+
+class FileSampleReader:
+    # One 'betasSample{i}.pt' file per sample
+
+    def __init__(self, folder, manifest=None):
+        self.folder = folder
+        if manifest is None:
+            _, _, files = next(os.walk(self.folder))
+            self.numberOfSamples = len(list(filter(lambda k: 'betas' in k, files)))
+        else:
+            self.numberOfSamples = manifest['numberOfSamples']
+
+    def getSample(self, index):
+        m = torch.load(os.path.join(self.folder, f'betasSample{index}.pt'))
+        return m['betas'], m['pilotSequence']
+
+    def getLogSample(self, index):
+        betas, pilotSequence = self.getSample(index)
+        return torch.log(betas.to(dtype=torch.float32)), pilotSequence
+
+    def __len__(self):
+        return self.numberOfSamples
+
+
+def openSampleReader(folder):
+    manifest = loadManifest(folder)
+    if manifest is None or manifest['format'] == 'files':
+        return FileSampleReader(folder, manifest)
+    return ShardedSampleReader(folder, manifest)
@@ -10,11 +10,20 @@ import psutil
 import cpuinfo  # Import the cpuinfo library
 
 
+LOCK_FOLDER = 'locks'  # lock files of folderLock, in the working directory
+
+
+def getSystemInfo():
+    return {
+                'os': platform.platform(),
+                'processorPlatform': platform.processor(),
+                'processorCpuInfo': cpuinfo.get_cpu_info().get('brand_raw', 'Unknown Processor'),
+                'ramGB': round(psutil.virtual_memory().total / (1024 ** 3), 2),
+            }
+
+
 def logSystemInfoAndLatency(simulationParameters, avgLatency):
-    osInfo = platform.platform()
-    platformCpuInfo = platform.processor()
-    cpuinfoCpuInfo = cpuinfo.get_cpu_info().get('brand_raw', 'Unknown Processor')
-    ramInfo = psutil.virtual_memory().total / (1024 ** 3)
+    systemInfo = getSystemInfo()
 
     fileName = "systemInfo"
     if simulationParameters.varyingNumberOfUsersFlag:
@@ -24,10 +33,10 @@ def logSystemInfoAndLatency(simulationParameters, avgLatency):
     
     fileName = fileName + ".txt"
 
-    systemInfo = f"Operating System: {osInfo}\n" \
-                 f"Processor (Platform): {platformCpuInfo}\n" \
-                 f"Processor (CPUInfo): {cpuinfoCpuInfo}\n" \
-                 f"RAM: {ramInfo:.2f} GB\n"\
+    systemInfo = f"Operating System: {systemInfo['os']}\n" \
+                 f"Processor (Platform): {systemInfo['processorPlatform']}\n" \
+                 f"Processor (CPUInfo): {systemInfo['processorCpuInfo']}\n" \
+                 f"RAM: {systemInfo['ramGB']:.2f} GB\n"\
                  f"avgLatency: {avgLatency}\n"
 
     filePath = os.path.join(simulationParameters.resultsBase, fileName)
@@ -49,6 +58,18 @@ def cleanFolders():
     dirs = glob.glob("updatedResults/")
     deleteFolder(*dirs)
     
+    dirs = glob.glob("geometryCache/")
+    deleteFolder(*dirs)
+    
+    dirs = glob.glob("baselineCache/")
+    deleteFolder(*dirs)
+    
+    dirs = glob.glob(f"{LOCK_FOLDER}/")
+    deleteFolder(*dirs)
+    
+    for lockFile in glob.glob("*.lock"):
+        os.remove(lockFile)
+    
     print(f"Cleaned all! ")
     exit()
 
@@ -62,48 +83,54 @@ def loadObject(filename):
         return pickle.load(inp)
 
 
+def folderLock(folder):
+    # Inter-process lock guarding the creation and deletion of folder (or of a file). All the lock
+    # files are kept in LOCK_FOLDER of the working directory, named after the absolute path of
+    # what they guard, so the concurrent runs started from the same directory serialize on them
+    # and -c removes them.
+    import hashlib
+    from filelock import FileLock
+    folder = os.path.abspath(folder)
+    folderHash = hashlib.sha256(folder.encode()).hexdigest()[:16]
+    os.makedirs(LOCK_FOLDER, exist_ok=True)
+    return FileLock(os.path.join(LOCK_FOLDER, f'{os.path.basename(folder)}.{folderHash}.lock'))
+
+
 def deleteFolder(*args):
+    # Each folder is first renamed atomically, so other processes never see it partially deleted,
+    # and then removed.
+    import uuid
     for folder in args:
+        folder = os.path.normpath(folder)
+        if not os.path.exists(folder):
+            continue
+
+        trashFolder = f'{folder}.deleted.{uuid.uuid4().hex}'
         for _ in range(5):
-            if not os.path.exists(folder):
+            try:
+                os.rename(folder, trashFolder)
                 break
-            shutil.rmtree(folder, ignore_errors=False, onerror=None)
-            time.sleep(0.5)
+            except FileNotFoundError:
+                break
+            except OSError:
+                time.sleep(0.5)
 
         if os.path.exists(folder):
             print(f"\n'{folder}' folder was not deleted")
             sys.exit()
+        shutil.rmtree(trashFolder, ignore_errors=True)
 
 
-def handleDeletionAndCreation(folder, numberOfSamples=None, retain=False, forceRetain= False):
-    if os.path.exists(folder):
-        if forceRetain:
-            return
-        oldNumberOfSamples = len(os.listdir(folder))
-        if retain:
-            if oldNumberOfSamples==numberOfSamples:
-                return
-            else:
-                response = queryFn(f"""
-Retain Failed!
-You request is to retain {numberOfSamples} number of samples,
-while we have {oldNumberOfSamples} samples in the folder {folder}.
-Do you want to overwrite the data folder [y/n]? """)
-                if response == 'n':
-                    print(f('Retaining operation for the data folder cannot be performed!'
-                            'Either set the set the --samples option to {oldNumberOfSamples}'
-                            'or --retain option to 0.'))
-                    sys.exit()
-    
-    import random
-    random.seed()
-    time.sleep(random.uniform(1, 20))
-    if os.path.exists(folder) and forceRetain:
+def handleDeletionAndCreation(folder, retain=False):
+    # Re-creates the folder empty, or keeps it as it is if retain is set.
+    if os.path.exists(folder) and retain:
         return
     
-    deleteFolder(folder)
-    
-    os.mkdir(folder)
+    with folderLock(folder):
+        if os.path.exists(folder) and retain:
+            return
+        deleteFolder(folder)
+        os.makedirs(folder)
 
 def deleteFolderContents(gradInpsFolder):
 
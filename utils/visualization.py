@@ -5,6 +5,8 @@ import seaborn as sns
 import pickle
 import textwrap
 
+from utils.resultsStore import openResultsReader
+
 
 # Predefined color map for algorithms
 algoColorMap = {
@@ -12,7 +14,11 @@ algoColorMap = {
     'APG': 'tab:orange',
     'TNN': 'tab:green',
     'FCN': 'tab:red',
-    'TDN': 'tab:purple'
+    'TDN': 'tab:purple',
+    'TNN+APG': 'tab:olive',
+    'FCN+APG': 'tab:brown',
+    'TNN-INT8': 'tab:cyan',
+    'FCN-INT8': 'tab:pink',
 }
 
 # Predefined line styles
@@ -20,10 +26,15 @@ lineStyles = ['-', '--', '-.', ':', (0, (3, 1, 1, 1)), (0, (3, 5, 1, 5)), (0, (1
 
 
 def fetchSeValues(resultsFolder, algoList, seMin):
+    resultsReader = openResultsReader(resultsFolder)
+    if resultsReader is not None:
+        return [[resultsReader.getSe(algo, seMin)] for algo in algoList]
+
+    # Older runs keep one file per algo and sample
     seOut = [[] for _ in algoList]
     for file in os.listdir(resultsFolder):
         for algoId, algo in enumerate(algoList):
-            if algo in file:
+            if file.startswith(f'{algo}ResultsSample'):
                 filePathAndName = os.path.join(resultsFolder, file)
                 tempArray = torch.load(filePathAndName)
                 if seMin:
@@ -393,7 +404,16 @@ def localPlotEdits(figIdx, plotFolder, outputFolder):
     pdfPlotFile = os.path.join(outputFolder, f'{pdfFileName}.png')
     fig2.savefig(pdfPlotFile)
 
-def individualPlots(resultsFolder, algoList, plotFolder, scenario, seMin):
+def seLossLabel(seArray, referenceSeArray, referenceAlgo):
+    # Change of the mean SE of an algo against referenceAlgo on the same samples, in percent
+    seChange = 100 * (seArray.mean() / referenceSeArray.mean() - 1)
+    return f' ({seChange.item():+.2f}% mean SE vs {referenceAlgo})'
+
+
+def individualPlots(resultsFolder, algoList, plotFolder, scenario, seMin, referenceAlgoDict=None):
+    # referenceAlgoDict maps an algo, e.g. 'TNN-INT8', to the algo its SE loss is reported against
+    # in the legend, e.g. 'TNN'.
+    referenceAlgoDict = referenceAlgoDict or {}
 
     fig, ax = plt.subplots()
     fig2, ax2 = plt.subplots()
@@ -403,20 +423,26 @@ def individualPlots(resultsFolder, algoList, plotFolder, scenario, seMin):
     seOut = fetchSeValues(resultsFolder, algoList, seMin)
 
     for algoId, algo in enumerate(algoList):
-        algo = algo.upper()
         seArray = torch.cat(seOut[algoId])
         seOutFinal = seArray.reshape((-1,))
 
         seSumFinal, _ = seOutFinal.sort()
+
+        seLoss = ''
+        referenceAlgo = referenceAlgoDict.get(algo)
+        if referenceAlgo in algoList:
+            referenceSeArray = torch.cat(seOut[algoList.index(referenceAlgo)]).reshape((-1,))
+            seLoss = seLossLabel(seOutFinal, referenceSeArray, referenceAlgo)
+        algo = algo.upper()
         
-        label = f'{scenarioName} {algo}'.replace('_', ' ')
+        label = f'{scenarioName} {algo}'.replace('_', ' ') + seLoss
         ax.plot(
                     seSumFinal.cpu().numpy(),
                     torch.linspace(0, 1, seSumFinal.size()[0]),
                     label=label
                 )
 
-        label = f'{scenarioName} {algo}'.replace('_', ' ')
+        label = f'{scenarioName} {algo}'.replace('_', ' ') + seLoss
         ax2 = sns.kdeplot(seSumFinal.cpu().numpy(), label=label)
     
     if seMin:
@@ -450,9 +476,16 @@ def individualPlots(resultsFolder, algoList, plotFolder, scenario, seMin):
         plotFile = os.path.join(plotFolder,f'scenario{scenario}PDF_full.png')
         fig2.savefig(plotFile)
 
-def performancePlotter(resultsFolder, algoList, plotFolder, scenario):
+def performancePlotter(resultsFolder, algoList, plotFolder, scenario, referenceAlgoDict=None):
     for seMin in [True, False]:
-        individualPlots(resultsFolder, algoList, plotFolder, scenario, seMin = seMin)
+        individualPlots(
+                            resultsFolder,
+                            algoList,
+                            plotFolder,
+                            scenario,
+                            seMin=seMin,
+                            referenceAlgoDict=referenceAlgoDict
+                        )
     plt.show()
 
 def consolidatedPlotter(figIdx, resultsFolders, algoLists, tags, tagsForNonML, plotFolder):